@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import gc
+import json
+import os
+import tracemalloc
+
+from cubic_sdk.cubic import Item as SDK_Node
+from remotefs import RemoteFS
+
+FILES = 20000
+KEY = 'benchmark'
+
+
+def make_items(crypto, files, blocks_per_file):
+    # Items as the server returns them for a tree synced with a key.
+    plain = []
+    for i in range(files):
+        meta = {'mode': 0o100644, 'mtime': 1500000000.0 + i, 'size': blocks_per_file * 4096}
+        plain.append(('dir%d/file%d' % (i % 100, i)).encode())
+        plain.append(json.dumps(meta).encode())
+    encrypted = crypto.parallel_encrypt(plain)
+    return [SDK_Node(next(encrypted), next(encrypted), [os.urandom(32).hex() for _ in range(blocks_per_file)])
+            for _ in range(files)]
+
+
+def measure(remotefs, blocks_per_file):
+    # Everything the tree keeps alive counts, including strings it shares
+    # with the items returned by the SDK. The peak is what generate_dict
+    # allocates on top of the items while it runs, decryption included.
+    gc.collect()
+    tracemalloc.start()
+    items = make_items(remotefs.crypto, FILES, blocks_per_file)
+    items_size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    remotefs.clear()
+    remotefs.generate_dict(items)
+    _, peak = tracemalloc.get_traced_memory()
+    del items
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return used, peak - items_size
+
+
+def main():
+    remotefs = RemoteFS(None, KEY)
+    remotefs.crypto.pool  # start the workers before anything is traced
+    try:
+        one, one_peak = measure(remotefs, 1)
+        nine, nine_peak = measure(remotefs, 9)
+    finally:
+        remotefs.crypto.close()
+    per_block = (nine - one) / (8 * FILES)
+    per_file = one / FILES - per_block
+    peak_per_block = (nine_peak - one_peak) / (8 * FILES)
+    peak_per_file = one_peak / FILES - peak_per_block
+    print('%s files: %.0f bytes per file, %.0f bytes per block' % (FILES, per_file, per_block))
+    print('peak while loading: %.0f bytes per file, %.0f bytes per block' % (peak_per_file, peak_per_block))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import time
+import tracemalloc
+
+import config
+from cubic_fuse import CubicFS
+from node import Node
+from remotefs import RemoteFS
+
+BLOCKS = 8
+ITERATIONS = 200
+
+
+def legacy_read(fs, path, size, offset):
+    # The read path before CubicFS.stream: concatenate whole blocks, then slice.
+    item = fs.remotefs.dict[path[1:]]
+    data = b''
+    start_block = offset // config.block_size
+    end_block = (offset + size - 1) // config.block_size
+    for block_hash in item.block_hashes[start_block:end_block + 1]:
+        data += fs.block_cache.get(block_hash, item.block_format)
+    return data[offset % config.block_size:offset % config.block_size + size]
+
+
+def make_fs():
+    remotefs = RemoteFS(None, None)
+    fs = CubicFS(remotefs)
+    fs.block_cache.memory.max_size = (BLOCKS + 1) * config.block_size
+    item = Node(is_dir=False, mode=0o100644, mtime=0)
+    item.size = BLOCKS * config.block_size
+    item.block_hashes = []
+    for i in range(BLOCKS):
+        block_hash = '%064x' % i
+        fs.block_cache.memory.put((block_hash, 0), os.urandom(config.block_size))
+        item.block_hashes.append(block_hash)
+    remotefs.dict['file'] = item
+    return fs
+
+
+def cases():
+    rnd = random.Random(0)
+    file_size = BLOCKS * config.block_size
+    return {
+        'small (4 KiB)': [(4096, rnd.randrange(file_size - 4096)) for _ in range(ITERATIONS)],
+        'block-aligned': [(config.block_size, rnd.randrange(BLOCKS) * config.block_size)
+                          for _ in range(ITERATIONS)],
+        'block-spanning': [(config.block_size, rnd.randrange(BLOCKS - 1) * config.block_size + config.block_size // 2)
+                           for _ in range(ITERATIONS)],
+    }
+
+
+def measure(read, fs, reads):
+    start = time.perf_counter()
+    for size, offset in reads:
+        read(fs, '/file', size, offset)
+    latency = (time.perf_counter() - start) / len(reads)
+    tracemalloc.start()
+    for size, offset in reads[:20]:
+        read(fs, '/file', size, offset)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return latency, peak
+
+
+def main():
+    fs = make_fs()
+    implementations = [('legacy', legacy_read), ('stream', lambda fs, *args: fs.read(*args))]
+    print('%-16s %-8s %12s %14s' % ('case', 'impl', 'latency', 'peak alloc'))
+    for name, reads in cases().items():
+        for impl, read in implementations:
+            for size, offset in reads[:5]:
+                assert read(fs, '/file', size, offset) == legacy_read(fs, '/file', size, offset)
+            latency, peak = measure(read, fs, reads)
+            print('%-16s %-8s %9.1f us %11.1f KiB' % (name, impl, latency * 1e6, peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import config
+
+config.cache_dir = tempfile.mkdtemp(prefix='cubic-bench-')
+
+import cubic_sync
+from cubic_fuse import CubicFS
+from cubic_http import CubicHTTPRequestHandler, ThreadPoolHTTPServer
+from fake_cubic import FakeCubic
+from localfs import LocalFS
+from remotefs import RemoteFS
+from utils import size
+
+KEY = 'benchmark'
+READ_SIZE = 128 * 1024
+RANDOM_READS = 200
+
+
+def write_file(path, file_size, rnd):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(rnd.randbytes(file_size))
+
+
+def small_files(root, rnd):
+    for i in range(2000):
+        write_file(os.path.join(root, 'small', 'd%02d' % (i % 20), 'f%d' % i), rnd.randrange(1, 16384), rnd)
+
+
+def huge_files(root, rnd):
+    for i in range(2):
+        write_file(os.path.join(root, 'huge', 'f%d' % i), 64 * 1024 * 1024 + rnd.randrange(config.block_size), rnd)
+
+
+def deep_tree(root, rnd):
+    path = os.path.join(root, 'deep')
+    for depth in range(40):
+        path = os.path.join(path, 'level%d' % depth)
+        for i in range(5):
+            write_file(os.path.join(path, 'f%d' % i), rnd.randrange(1, 65536), rnd)
+
+
+TREES = [('small files', small_files), ('huge files', huge_files), ('deep nesting', deep_tree)]
+
+
+def tree_size(root):
+    files = total = 0
+    for dir_path, _, names in os.walk(root):
+        for name in names:
+            files += 1
+            total += os.path.getsize(os.path.join(dir_path, name))
+    return files, total
+
+
+def bench_sync(server):
+    # Each tree is added to the same source directory and synced on its own,
+    # so every run uploads exactly one new tree.
+    root = tempfile.mkdtemp(prefix='cubic-bench-src-')
+    rnd = random.Random(0)
+    for name, generate in TREES:
+        before_files, before_size = tree_size(root)
+        generate(root, rnd)
+        files, total = tree_size(root)
+        files -= before_files
+        total -= before_size
+        remotefs = RemoteFS(server, KEY)
+        start = time.perf_counter()
+        cubic_sync.sync(LocalFS(root), remotefs)
+        elapsed = time.perf_counter() - start
+        remotefs.crypto.close()
+        print('sync %-14s %6s files %10s %8.2f s %12s/s %8.1f files/s'
+              % (name, files, size(total), elapsed, size(total / elapsed), files / elapsed))
+    return root
+
+
+def bench_fetch(server):
+    remotefs = RemoteFS(server, KEY)
+    start = time.perf_counter()
+    remotefs.fetch_remote()
+    elapsed = time.perf_counter() - start
+    print('fetch tree         %6s items %8.2f s' % (len(remotefs.dict), elapsed))
+    return remotefs
+
+
+def bench_fuse(remotefs):
+    path = '/huge/f0'
+    file_size = remotefs.dict[path[1:]].size
+    fs = CubicFS(remotefs)
+    for name in 'cold', 'warm':
+        start = time.perf_counter()
+        reads = 0
+        for offset in range(0, file_size, READ_SIZE):
+            fs.read(path, READ_SIZE, offset)
+            reads += 1
+        elapsed = time.perf_counter() - start
+        print('fuse sequential %-4s %8.1f us/read %12s/s' % (name, elapsed / reads * 1e6, size(file_size / elapsed)))
+    fs = CubicFS(remotefs)
+    rnd = random.Random(1)
+    start = time.perf_counter()
+    for _ in range(RANDOM_READS):
+        fs.read(path, 4096, rnd.randrange(file_size - 4096))
+    elapsed = time.perf_counter() - start
+    print('fuse random 4 KiB    %8.1f us/read' % (elapsed / RANDOM_READS * 1e6))
+
+
+def bench_http(remotefs):
+    httpd = ThreadPoolHTTPServer(('127.0.0.1', 0), CubicHTTPRequestHandler, config.http_workers)
+    httpd.fs = CubicFS(remotefs)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%s/huge/f1' % httpd.server_address[1]
+    try:
+        for name in 'cold', 'warm':
+            start = time.perf_counter()
+            total = 0
+            with urllib.request.urlopen(url) as response:
+                while True:
+                    data = response.read(1024 * 1024)
+                    if not data:
+                        break
+                    total += len(data)
+            elapsed = time.perf_counter() - start
+            print('http stream %-4s    %10s %8.2f s %12s/s' % (name, size(total), elapsed, size(total / elapsed)))
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def main():
+    # Usage: benchmark.py [latency in ms] [bandwidth in MiB/s]
+    logging.basicConfig(level=logging.WARNING)
+    latency = float(sys.argv[1]) / 1000 if len(sys.argv) >= 2 else 0
+    bandwidth = float(sys.argv[2]) * 1024 * 1024 if len(sys.argv) >= 3 else None
+    server = FakeCubic(latency, bandwidth)
+    print('latency %.1f ms, bandwidth %s' % (latency * 1000, size(bandwidth) + '/s' if bandwidth else 'unlimited'))
+    root = bench_sync(server)
+    remotefs = bench_fetch(server)
+    try:
+        bench_fuse(remotefs)
+        bench_http(remotefs)
+    finally:
+        remotefs.crypto.close()
+        shutil.rmtree(root)
+        shutil.rmtree(config.cache_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+import collections
+import concurrent.futures
+import config
+import logging
+import metrics
+import os
+import threading
+
+
+# Blocks are cached by (hash, block_format): the same encrypted block
+# decodes differently in raw and compressed files.
+
+
+class MemoryCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.blocks = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        data = self.blocks.get(key)
+        if data is not None:
+            self.blocks.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_size:
+            return
+        if key in self.blocks:
+            self.size -= len(self.blocks.pop(key))
+        self.blocks[key] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            _, evicted = self.blocks.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class DiskCache:
+    # Decrypted blocks stored one file per hash and format. Recency is kept
+    # in the file mtime so the LRU order survives remounts.
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.blocks = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        entries = []
+        for entry in os.scandir(path):
+            block_hash, _, block_format = entry.name.partition('-')
+            if not block_format.isdigit():
+                # Temporary files, and blocks cached before the format was
+                # part of the name.
+                os.unlink(entry.path)
+            elif entry.is_file():
+                st = entry.stat()
+                entries.append((st.st_mtime, (block_hash, int(block_format)), st.st_size))
+        for _, key, size in sorted(entries):
+            self.blocks[key] = size
+            self.size += size
+        self._evict()
+        logging.info('Disk block cache: %s blocks, %s bytes', len(self.blocks), self.size)
+
+    def _file(self, key):
+        return os.path.join(self.path, '%s-%s' % key)
+
+    def _evict(self):
+        while self.size > self.max_size:
+            key, size = self.blocks.popitem(last=False)
+            self.size -= size
+            try:
+                os.unlink(self._file(key))
+            except OSError as e:
+                logging.warning('Failed to evict cached block: %s', e)
+
+    def get(self, key):
+        # Reads the block outside the lock, so reads of different blocks run
+        # in parallel. Callers keep it in memory, so the mtime is only
+        # updated once per read from disk.
+        with self.lock:
+            if key not in self.blocks:
+                return None
+            self.blocks.move_to_end(key)
+        try:
+            with open(self._file(key), 'rb') as f:
+                os.utime(f.fileno())
+                return f.read()
+        except OSError as e:
+            logging.warning('Dropping unreadable cached block: %s', e)
+            with self.lock:
+                size = self.blocks.pop(key, None)
+                if size is not None:
+                    self.size -= size
+            return None
+
+    def put(self, key, data):
+        with self.lock:
+            self._put(key, data)
+
+    def _put(self, key, data):
+        if len(data) > self.max_size or key in self.blocks:
+            return
+        tmp_path = self._file(key) + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._file(key))
+        except OSError as e:
+            logging.warning('Failed to cache block on disk: %s', e)
+            return
+        self.blocks[key] = len(data)
+        self.size += len(data)
+        self._evict()
+
+
+class BlockCache:
+    # Safe to share between threads. Concurrent misses on one hash share a
+    # single fetch, and at most fetch_concurrency fetches hit the server at
+    # once.
+    def __init__(self, remotefs, max_size=config.block_cache_size, disk_path=None,
+                 disk_max_size=config.block_cache_disk_size, prefetch_workers=config.prefetch_workers,
+                 fetch_concurrency=config.block_fetch_concurrency):
+        self.remotefs = remotefs
+        self.memory = MemoryCache(max_size)
+        self.disk = DiskCache(disk_path, disk_max_size) if disk_path and disk_max_size else None
+        self.lock = threading.Lock()
+        self.fetching = {}
+        self.fetch_slots = threading.BoundedSemaphore(fetch_concurrency)
+        self.executor = concurrent.futures.ThreadPoolExecutor(prefetch_workers)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.prefetches = 0
+
+    def _get_block(self, block_hash, block_format):
+        return self.remotefs.get_block(block_hash, block_format)
+
+    def _lookup(self, key):
+        data = self.memory.get(key)
+        if data is not None:
+            self.hits += 1
+            metrics.inc('block_cache_hits')
+        return data
+
+    def _prefetch(self, key, future):
+        with self.lock:
+            if future.running() or future.done():
+                # A demand read got to it first.
+                return
+            future.set_running_or_notify_cancel()
+        self._fetch(key, future)
+
+    def _fetch(self, key, future):
+        try:
+            with self.fetch_slots:
+                data = self._get_block(*key)
+        except BaseException as e:
+            with self.lock:
+                del self.fetching[key]
+            future.set_exception(e)
+            return
+        with self.lock:
+            self.memory.put(key, data)
+            del self.fetching[key]
+        future.set_result(data)
+        if self.disk is not None:
+            self.disk.put(key, data)
+
+    def get(self, block_hash, block_format=0):
+        key = block_hash, block_format
+        with self.lock:
+            data = self._lookup(key)
+        if data is not None:
+            return data
+        if self.disk is not None:
+            # The disk tier has its own lock; its file I/O must not stall
+            # every other read on self.lock.
+            data = self.disk.get(key)
+            if data is not None:
+                with self.lock:
+                    self.disk_hits += 1
+                    self.memory.put(key, data)
+                metrics.inc('block_cache_disk_hits')
+                return data
+        with self.lock:
+            # Another thread may have fetched the block in the meantime.
+            data = self._lookup(key)
+            if data is not None:
+                return data
+            future = self.fetching.get(key)
+            owner = future is None or not future.running()
+            if owner:
+                # A prefetch still waiting in the queue is fetched here
+                # instead of behind the other prefetches.
+                self.misses += 1
+                metrics.inc('block_cache_misses')
+                if future is None:
+                    future = self.fetching[key] = concurrent.futures.Future()
+                future.set_running_or_notify_cancel()
+            else:
+                self.hits += 1
+                metrics.inc('block_cache_hits')
+        if owner:
+            logging.debug('Cache miss')
+            self._fetch(key, future)
+        return future.result()
+
+    def prefetch(self, block_hash, block_format=0):
+        key = block_hash, block_format
+        with self.lock:
+            if key in self.fetching or self.memory.get(key) is not None:
+                return
+            if self.disk is not None and key in self.disk.blocks:
+                return
+            self.prefetches += 1
+            metrics.inc('block_cache_prefetches')
+            future = self.fetching[key] = concurrent.futures.Future()
+        self.executor.submit(self._prefetch, key, future)
+
+    def stats(self):
+        stats = {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'prefetches': self.prefetches,
+            'memory_blocks': len(self.memory.blocks),
+            'memory_size': self.memory.size,
+        }
+        if self.disk is not None:
+            stats['disk_blocks'] = len(self.disk.blocks)
+            stats['disk_size'] = self.disk.size
+        return stats
@@ -0,0 +1,122 @@
+import bisect
+
+DIGEST_SIZE = 32
+
+
+class BlockHashes:
+    # The block hashes of one file as contiguous binary digests. It behaves
+    # like a read-only list of hex strings, the format used by the SDK.
+    __slots__ = ('data',)
+
+    def __init__(self, hashes=()):
+        if isinstance(hashes, BlockHashes):
+            self.data = hashes.data
+        else:
+            self.data = b''.join(bytes.fromhex(h) for h in hashes)
+
+    def __len__(self):
+        return len(self.data) // DIGEST_SIZE
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('block index out of range')
+        return self.data[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE].hex()
+
+    def __iter__(self):
+        for digest in self.digests():
+            yield digest.hex()
+
+    def __eq__(self, other):
+        if isinstance(other, BlockHashes):
+            return self.data == other.data
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'BlockHashes(%r)' % list(self)
+
+    def digests(self):
+        for i in range(0, len(self.data), DIGEST_SIZE):
+            yield self.data[i:i + DIGEST_SIZE]
+
+
+class _SortedDigests:
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data) // DIGEST_SIZE
+
+    def __getitem__(self, index):
+        return self.data[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE]
+
+
+class BlockHashSet:
+    # A set of hex block hashes kept as one sorted array of binary digests.
+    # New hashes go to a small set that is merged into the array once it
+    # grows as large as the array itself.
+    def __init__(self, digests=()):
+        # Digests are bucketed by their first byte, so only one bucket at a
+        # time is ever split into separate bytes objects for sorting.
+        buckets = [bytearray() for _ in range(256)]
+        for digest in digests:
+            buckets[digest[0]] += digest
+        data = bytearray()
+        for i, bucket in enumerate(buckets):
+            buckets[i] = None
+            bucket = bytes(bucket)
+            data += b''.join(sorted({bucket[j:j + DIGEST_SIZE] for j in range(0, len(bucket), DIGEST_SIZE)}))
+        self.sorted = _SortedDigests(data)
+        self.pending = set()
+
+    def __len__(self):
+        return len(self.sorted) + len(self.pending)
+
+    def __iter__(self):
+        for i in range(len(self.sorted)):
+            yield self.sorted[i].hex()
+        for digest in list(self.pending):
+            yield digest.hex()
+
+    def _contains(self, digest):
+        i = bisect.bisect_left(self.sorted, digest)
+        return i < len(self.sorted) and self.sorted[i] == digest or digest in self.pending
+
+    def __contains__(self, block_hash):
+        try:
+            return self._contains(bytes.fromhex(block_hash))
+        except (TypeError, ValueError):
+            return False
+
+    def add(self, block_hash):
+        digest = bytes.fromhex(block_hash)
+        if not self._contains(digest):
+            self.pending.add(digest)
+            if len(self.pending) > max(len(self.sorted), 1 << 16):
+                self._merge()
+
+    def update(self, block_hashes):
+        for block_hash in block_hashes:
+            self.add(block_hash)
+
+    def _merge(self):
+        # Copies runs of the sorted array between the new digests instead of
+        # splitting it into digests.
+        view = memoryview(self.sorted.data)
+        parts = []
+        prev = 0
+        for digest in sorted(self.pending):
+            i = bisect.bisect_left(self.sorted, digest)
+            parts.append(view[prev * DIGEST_SIZE:i * DIGEST_SIZE])
+            parts.append(digest)
+            prev = i
+        parts.append(view[prev * DIGEST_SIZE:])
+        self.sorted = _SortedDigests(b''.join(parts))
+        self.pending = set()
@@ -0,0 +1,104 @@
+import bisect
+import config
+import hashlib
+import os
+
+# FastCDC-style content-defined chunking with a gear rolling hash and
+# normalized chunk sizes (a stricter mask before the average size and a
+# looser one after it).
+#
+# The hash after a byte only depends on the 64 bytes ending there, so the
+# slow part, hashing every byte, is split into segments that are scanned
+# independently in the pool. Cut points are then picked from the few
+# positions that passed the looser mask.
+
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+MASK64 = (1 << 64) - 1
+WINDOW = 64
+
+
+def _mask(bits):
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def masks(avg_size):
+    bits = avg_size.bit_length() - 1
+    return _mask(bits + 1), _mask(bits - 1)
+
+
+def params():
+    if config.content_defined_chunking:
+        return [config.cdc_min_size, config.cdc_avg_size, config.cdc_max_size]
+    return [config.block_size]
+
+
+def segments(file_size, segment_size=None):
+    segment_size = segment_size or config.cdc_segment_size
+    return [(start, min(start + segment_size, file_size)) for start in range(0, file_size, segment_size)]
+
+
+def scan(path, start, end, avg_size=None):
+    # Returns [(offset, hash)] for every offset in (start, end] where the
+    # hash of the bytes before it passes the looser mask.
+    _, mask_l = masks(avg_size or config.cdc_avg_size)
+    read_start = max(0, start - WINDOW + 1)
+    with open(path, 'rb') as f:
+        f.seek(read_start)
+        data = f.read(end - read_start)
+    if len(data) != end - read_start:
+        raise OSError('File changed while syncing: %s' % path)
+    h = 0
+    hits = []
+    for offset, g in enumerate(map(GEAR.__getitem__, data), read_start + 1):
+        h = ((h << 1) + g) & MASK64
+        if not h & mask_l:
+            hits.append((offset, h))
+    return [hit for hit in hits if hit[0] > start]
+
+
+def cut_points(path, file_size, candidates, min_size=None, avg_size=None, max_size=None):
+    # Turns the merged scan results of a file into chunk lengths. The hash
+    # restarts at min_size into every chunk, so the first bytes after that
+    # are hashed here, where the window is still shorter than 64 bytes.
+    min_size = min_size or config.cdc_min_size
+    avg_size = avg_size or config.cdc_avg_size
+    max_size = max_size or config.cdc_max_size
+    mask_s, mask_l = masks(avg_size)
+    offsets = [offset for offset, _ in candidates]
+    lengths = []
+    start = 0
+    with open(path, 'rb') as f:
+        while start < file_size:
+            n = min(file_size - start, max_size)
+            if n > min_size:
+                n = _cut_point(f, start, n, offsets, candidates, min_size, avg_size, mask_s, mask_l)
+            lengths.append(n)
+            start += n
+    return lengths
+
+
+def _cut_point(f, start, n, offsets, candidates, min_size, avg_size, mask_s, mask_l):
+    begin = start + min_size
+    normal = start + min(avg_size, n)
+    stop = start + n
+    head = os.pread(f.fileno(), min(WINDOW - 1, stop - begin), begin)
+    h = 0
+    for offset, b in enumerate(head, begin + 1):
+        h = ((h << 1) + GEAR[b]) & MASK64
+        if not h & (mask_s if offset <= normal else mask_l):
+            return offset - start
+    for i in range(bisect.bisect_right(offsets, begin + len(head)), len(offsets)):
+        offset, h = candidates[i]
+        if offset > stop:
+            break
+        if offset > normal or not h & mask_s:
+            return offset - start
+    return n
+
+
+def chunk_file(path, min_size=None, avg_size=None, max_size=None):
+    file_size = os.path.getsize(path)
+    candidates = []
+    for start, end in segments(file_size):
+        candidates.extend(scan(path, start, end, avg_size))
+    return cut_points(path, file_size, candidates, min_size, avg_size, max_size)
@@ -0,0 +1,58 @@
+import config
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Blocks of files whose meta has block_format >= 1 start with a one-byte
+# header naming the compression method. Files without block_format keep
+# raw blocks, so everything uploaded before stays readable.
+BLOCK_FORMAT = 1
+
+RAW = 0
+ZLIB = 1
+ZSTD = 2
+
+
+def _compress(method, data, level):
+    if method == ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return zlib.compress(data, level)
+
+
+def method():
+    if config.compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstandard is not installed')
+        return ZSTD
+    if config.compression == 'zlib':
+        return ZLIB
+    raise ValueError('Unknown compression: %s' % config.compression)
+
+
+def pack_block(data):
+    m = method()
+    sample = data[:config.compression_sample_size]
+    if len(_compress(m, sample, 1)) > len(sample) * config.compression_max_ratio:
+        return bytes([RAW]) + data
+    compressed = _compress(m, data, config.compression_level)
+    if len(compressed) > len(data) * config.compression_max_ratio:
+        return bytes([RAW]) + data
+    return bytes([m]) + compressed
+
+
+def unpack_block(data, block_format):
+    if not block_format:
+        return data
+    m = data[0]
+    if m == RAW:
+        return data[1:]
+    if m == ZLIB:
+        return zlib.decompress(data[1:])
+    if m == ZSTD:
+        if zstandard is None:
+            raise RuntimeError('zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompress(data[1:])
+    raise ValueError('Unknown block compression method: %s' % m)
@@ -1,11 +1,72 @@
 import hashlib
 import logging
+import multiprocessing
+import os
 
 hash_algo = lambda block: hashlib.sha3_256(block).hexdigest()
 block_size = 4 * 1024 * 1024
-upload_max_size = block_size * 500 # 2 GB
+upload_max_size = block_size * 500 # 2 GB, in memory and spilled to disk
+upload_memory_size = block_size * 64 # 256 MB
+upload_batch_size = block_size * 8
+upload_threads = 4
+upload_retries = 5
+upload_retry_delay = 1
+sync_checkpoint_interval = 300
+tree_batch_size = 16 * 1024 * 1024
+watch_debounce = 2
+watch_max_delay = 60
+watch_rescan_interval = 24 * 3600
+watch_retry_delay = 60
+crypto_workers = multiprocessing.cpu_count()
+crypto_batch_size = 256
 
 log_level = logging.INFO
 log_format = '%(asctime)s.%(msecs)03d %(levelname)s %(message)s'
 
 check_integrity = False
+verify_workers = 8
+verify_batch_size = 1000
+verify_max_age = 30 * 24 * 3600
+verify_sample_rate = 0.0  # fraction of recently verified blocks checked again anyway
+
+cache_dir = os.path.expanduser('~/.cache/cubic_client')
+local_index = True
+tree_cache = True
+tree_cache_interval = 600  # seconds between snapshot saves after tree updates
+
+scan_workers = 16
+scan_lookahead = 16  # subdirectories listed ahead per directory being walked
+scan_progress_interval = 10
+
+content_defined_chunking = False
+cdc_min_size = 1024 * 1024
+cdc_avg_size = block_size
+cdc_max_size = block_size * 4
+cdc_segment_size = 16 * 1024 * 1024 # bytes hashed per pool task
+
+compression = None  # None, 'zlib' or 'zstd'
+compression_level = 3
+compression_sample_size = 64 * 1024
+compression_max_ratio = 0.9
+
+pack_small_files = False
+pack_max_file_size = 64 * 1024
+pack_size = block_size
+
+block_cache_size = 64 * 1024 * 1024
+block_cache_disk_size = 0  # decrypted blocks are kept in plain text under cache_dir
+prefetch_workers = 4
+block_fetch_concurrency = 8
+fuse_threads = True  # False serves FUSE requests on a single thread
+readahead_max_blocks = 8
+readahead_max_files = 1024
+
+http_workers = 16
+
+metrics = False
+metrics_interval = 60
+metrics_path = None  # JSON snapshots are logged when not set
+metrics_port = None  # serves Prometheus metrics on localhost when set
+
+restore_workers = 8
+restore_checkpoint_interval = 10
@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
+import bisect
+import collections
+import hashlib
+import itertools
 import logging
 import sys
 import config
+import metrics
 import os
-import time
+import threading
 
+from blockcache import BlockCache
 from remotefs import RemoteFS
+from utils import state_file
 from errno import ENOENT
 from cubic_sdk.cubic import Cubic as CubicServer
 
@@ -24,45 +31,20 @@ except EnvironmentError:
         pass
 
 
-class BlockCache:
-    def __init__(self, remotefs, max_size=16 * 1024 * 1024):
-        self.cache = {}
-        self.remotefs = remotefs
-        self.max_size = max_size
-
-    def _get_block(self, block_hash):
-        return self.remotefs.get_block(block_hash)
-
-    def get(self, block_hash):
-        if block_hash not in self.cache:
-            logging.debug('Cache miss')
-            data = self._get_block(block_hash)
-            while sum(len(block) for block, _ in self.cache.values()) + len(data) > self.max_size:
-                oldest = time.time()
-                for h, (block, t) in self.cache.items():
-                    if t < oldest:
-                        oldest = t
-                        oldest_hash = h
-                del self.cache[oldest_hash]
-            logging.debug('Cache block count = %s, total size = %s',
-                          len(self.cache), sum(len(block) for block, _ in self.cache.values()))
-        else:
-            logging.debug('Cache hit')
-            data, _ = self.cache[block_hash]
-        self.cache[block_hash] = data, time.time()
-        return data
-
-
 class CubicFS(LoggingMixIn, Operations):
-    def __init__(self, user, token, key):
-        self.remotefs = RemoteFS(CubicServer(user, token), key)
-        self.remotefs.fetch_remote()
-        self.block_cache = BlockCache(self.remotefs)
+    def __init__(self, remotefs):
+        self.remotefs = remotefs
+        disk_path = state_file('blocks', remotefs.crypto.key) if config.block_cache_disk_size else None
+        self.block_cache = BlockCache(self.remotefs, disk_path=disk_path)
+        self.block_offsets = collections.OrderedDict()
+        self.block_offsets_lock = threading.Lock()
+        self.readahead = collections.OrderedDict()
+        self.readahead_lock = threading.Lock()
 
     def getattr(self, path, fh=None):
         path = path[1:]
-        if path in self.remotefs.dict:
-            item = self.remotefs.dict[path]
+        item = self.remotefs.dict.get(path)
+        if item is not None:
             st_mtime = item.mtime
             st_atime = item.mtime
             st_ctime = item.mtime
@@ -77,41 +59,123 @@ class CubicFS(LoggingMixIn, Operations):
             raise FuseOSError(ENOENT)
 
     def read(self, path, size, offset, fh=None):
+        item = self.remotefs.dict.get(path[1:])
+        if item is not None and not item.is_dir and item.pack_offset is None and offset < item.size:
+            # Fast path for reads within one block: a single slice of it.
+            end = min(offset + size, item.size)
+            if item.block_sizes is None:
+                block_index = offset // config.block_size
+                end_block = (end - 1) // config.block_size
+                block_offset = block_index * config.block_size
+            else:
+                block_index, end_block, block_offset = self.block_range(path[1:], item, offset, end - offset)
+            if block_index == end_block:
+                block = self.block_cache.get(item.block_hashes[block_index], item.block_format)
+                data = block[offset - block_offset:end - block_offset]
+                self.prefetch(path[1:], item, offset, len(data), block_index)
+                return data
+        chunks = list(self.stream(path, offset, offset + size))
+        if len(chunks) == 1 and isinstance(chunks[0].obj, bytes) and len(chunks[0]) == len(chunks[0].obj):
+            return chunks[0].obj
+        return b''.join(chunks)
+
+    def stream(self, path, offset, end):
+        # Yields views of cached blocks covering [offset, end) one block at a
+        # time, without concatenating them.
         path = path[1:]
-        if path in self.remotefs.dict and not self.remotefs.dict[path].is_dir:
-            item = self.remotefs.dict[path]
-            data = b''
+        item = self.remotefs.dict.get(path)
+        if item is None or item.is_dir:
+            raise FuseOSError(ENOENT)
+        end = min(end, item.size)
+        if item.pack_offset is not None:
+            # A small file stored inside a shared pack block.
+            if offset < end:
+                block = self.block_cache.get(item.block_hashes[0], item.block_format)
+                yield memoryview(block)[item.pack_offset + offset:item.pack_offset + end]
+            return
+        while offset < end:
+            block_index, _, block_offset = self.block_range(path, item, offset, 1)
+            logging.debug('Path: %s, hash: %s', path, item.block_hashes[block_index])
+            block = self.block_cache.get(item.block_hashes[block_index], item.block_format)
+            chunk = memoryview(block)[offset - block_offset:end - block_offset]
+            if not chunk:
+                break
+            self.prefetch(path, item, offset, len(chunk), block_index)
+            yield chunk
+            offset += len(chunk)
+
+    def etag(self, path):
+        item = self.remotefs.dict[path[1:]]
+        h = hashlib.sha256('{} {} {}'.format(item.size, item.mtime, item.pack_offset).encode())
+        for block_hash in item.block_hashes:
+            h.update(block_hash.encode())
+        return '"%s"' % h.hexdigest()[:32]
+
+    def prefetch(self, path, item, offset, size, end_block):
+        # Grow the read-ahead window while a file is read sequentially and
+        # drop it on the first random access.
+        with self.readahead_lock:
+            next_offset, window = self.readahead.pop(path, (0, 0))
+            if offset == next_offset:
+                window = min(max(window * 2, 1), config.readahead_max_blocks)
+            else:
+                window = 0
+            self.readahead[path] = offset + size, window
+            if len(self.readahead) > config.readahead_max_files:
+                self.readahead.popitem(last=False)
+        if window:
+            for block_hash in item.block_hashes[end_block + 1:end_block + 1 + window]:
+                self.block_cache.prefetch(block_hash, item.block_format)
+
+    def block_range(self, path, item, offset, size):
+        if item.block_sizes is None:
             start_block = offset // config.block_size
             end_block = (offset + size - 1) // config.block_size
-            for block_hash in item.block_hashes[start_block:end_block + 1]:
-                logging.debug('Path: %s, hash: %s', path, block_hash)
-                block = self.block_cache.get(block_hash)
-                data += block
-            return data[offset % config.block_size:offset % config.block_size + size]
-        else:
-            raise FuseOSError(ENOENT)
+            return start_block, end_block, start_block * config.block_size
+        # Chunk offsets of the most recently read files with content-defined
+        # chunking, dropped when the node is replaced.
+        with self.block_offsets_lock:
+            cached_item, offsets = self.block_offsets.pop(path, (None, None))
+        if cached_item is not item:
+            offsets = [0] + list(itertools.accumulate(item.block_sizes))
+        with self.block_offsets_lock:
+            self.block_offsets[path] = item, offsets
+            if len(self.block_offsets) > config.readahead_max_files:
+                self.block_offsets.popitem(last=False)
+        start_block = bisect.bisect_right(offsets, offset) - 1
+        end_block = bisect.bisect_right(offsets, offset + size - 1) - 1
+        return start_block, end_block, offsets[start_block]
+
+    def destroy(self, path):
+        logging.info('Block cache stats: %s', self.block_cache.stats())
+
+    def is_dir(self, path):
+        path = path[1:]
+        item = self.remotefs.dict.get(path)
+        return path == '' or item is not None and item.is_dir
 
     def readdir(self, path, fh=None):
-        items = ['.', '..']
-        path = path[1:]
-        if path == '':
-            for p in self.remotefs.dict:
-                if p and '/' not in p:
-                    items.append(p)
-            return items
-        elif path in self.remotefs.dict and self.remotefs.dict[path].is_dir:
-            for p in self.remotefs.dict:
-                if p.startswith(path + '/') and '/' not in p[len(path) + 1:]:
-                    items.append(p[len(path) + 1:])
-            return items
+        if self.is_dir(path):
+            return ['.', '..'] + list(self.remotefs.children.get(path[1:], ()))
         else:
             raise FuseOSError(ENOENT)
 
 
+def connect(user, token, key):
+    cache_path = state_file('tree', user, key) if config.tree_cache else None
+    remotefs = RemoteFS(CubicServer(user, token), key, cache_path)
+    if remotefs.load_cache():
+        threading.Thread(target=remotefs.fetch_remote, daemon=True).start()
+    else:
+        remotefs.fetch_remote()
+    return CubicFS(remotefs)
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
+    metrics.start()
     if len(sys.argv) >= 5:
         key = sys.argv[4]
     else:
         key = None
-    fuse = FUSE(CubicFS(sys.argv[1], sys.argv[2], key), sys.argv[3], foreground=True)
+    fuse = FUSE(connect(sys.argv[1], sys.argv[2], key), sys.argv[3], foreground=True, nothreads=not config.fuse_threads)
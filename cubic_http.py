@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
+import config
+import email.utils
+import metrics
 import html
 import logging
 import os
@@ -9,9 +13,58 @@ import sys
 import urllib.parse
 from http import HTTPStatus
 from http.server import SimpleHTTPRequestHandler
-from config import block_size
 
-from cubic_fuse import CubicFS, FuseOSError
+from cubic_fuse import CubicFS, FuseOSError, connect
+
+
+class ThreadPoolHTTPServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, max_workers):
+        super().__init__(server_address, handler_class)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+def parse_range(header, size):
+    # Returns an inclusive (start, end) pair, None if the header should be
+    # ignored (multiple or malformed ranges) or False if it is unsatisfiable.
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0:
+                return False
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    return start, end
 
 
 class CubicHTTPRequestHandler(SimpleHTTPRequestHandler):
@@ -46,6 +99,21 @@ class CubicHTTPRequestHandler(SimpleHTTPRequestHandler):
             path += '/'
         return path
 
+    def not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, IndexError, OverflowError, ValueError):
+                return False
+            if since.tzinfo is not None:
+                return int(mtime) <= since.timestamp()
+        return False
+
     def send_head(self):
         self.server.fs: CubicFS
         self.directory = '/'
@@ -66,18 +134,42 @@ class CubicHTTPRequestHandler(SimpleHTTPRequestHandler):
             except FuseOSError:
                 self.send_error(HTTPStatus.NOT_FOUND, "File not found")
                 return
+            size = attr['st_size']
+            etag = self.server.fs.etag(path)
+            last_modified = self.date_time_string(attr['st_mtime'])
+            if self.not_modified(etag, attr['st_mtime']):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", last_modified)
+                self.end_headers()
+                return
+            start, end = 0, size - 1
+            status = HTTPStatus.OK
+            range_header = self.headers.get('Range')
+            if_range = self.headers.get('If-Range')
+            if range_header and (not if_range or if_range.strip() in (etag, last_modified)):
+                byte_range = parse_range(range_header, size)
+                if byte_range is False:
+                    self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.send_header("Content-Range", "bytes */%s" % size)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if byte_range is not None:
+                    start, end = byte_range
+                    status = HTTPStatus.PARTIAL_CONTENT
             ctype = self.guess_type(path)
-            self.send_response(HTTPStatus.OK)
+            self.send_response(status)
             self.send_header("Content-type", ctype)
-            self.send_header("Content-Length", str(attr['st_size']))
-            self.send_header("Last-Modified", self.date_time_string(attr['st_mtime']))
+            self.send_header("Content-Length", str(end - start + 1))
+            if status == HTTPStatus.PARTIAL_CONTENT:
+                self.send_header("Content-Range", "bytes %s-%s/%s" % (start, end, size))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
             self.end_headers()
-            start = 0
-            size = attr['st_size']
             yield b''
-            while start < size:
-                yield self.server.fs.read(path, min(block_size, size - start), start)
-                start += block_size
+            yield from self.server.fs.stream(path, start, end + 1)
         else:  # dir
             parts = urllib.parse.urlsplit(self.path)
             if not parts.path.endswith('/'):
@@ -109,11 +201,7 @@ class CubicHTTPRequestHandler(SimpleHTTPRequestHandler):
                 r.append('<hr>\n<ul>')
                 for name in list:
                     displayname = linkname = name
-                    try:
-                        self.server.fs.readdir(os.path.join(self.path, name))
-                    except:
-                        pass
-                    else:
+                    if self.server.fs.is_dir(posixpath.join(path_no_trailing, name)):
                         displayname = name + "/"
                         linkname = name + "/"
                     r.append('<li><a href="%s">%s</a></li>'
@@ -136,10 +224,11 @@ if __name__ == '__main__':
         key = None
 
     logging.basicConfig(level=logging.INFO)
+    metrics.start()
 
     LISTEN = "127.0.0.1", 8000
 
-    with socketserver.TCPServer(LISTEN, CubicHTTPRequestHandler) as httpd:
-        httpd.fs = CubicFS(sys.argv[1], sys.argv[2], key)
+    with ThreadPoolHTTPServer(LISTEN, CubicHTTPRequestHandler, config.http_workers) as httpd:
+        httpd.fs = connect(sys.argv[1], sys.argv[2], key)
         logging.info('Listening at %s', LISTEN)
         httpd.serve_forever()
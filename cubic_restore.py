@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import coloredlogs
+import collections
+import concurrent.futures
+import itertools
+import logging
+import os
+import posixpath
+import sqlite3
+import stat
+import sys
+import time
+import config
+import metrics
+from cubic_sdk.cubic import Cubic as CubicServer
+from remotefs import RemoteFS
+import getpass
+from utils import size, state_file
+
+
+class RestoreJournal:
+    # Blocks already written into each partial file, so an interrupted
+    # restore only fetches what is still missing.
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS blocks (path BLOB, block_index INTEGER, hash TEXT, '
+                        'PRIMARY KEY (path, block_index))')
+
+    @staticmethod
+    def _encode(path):
+        return path.encode('utf8', errors='surrogateescape')
+
+    def done(self, path):
+        return dict(self.db.execute('SELECT block_index, hash FROM blocks WHERE path = ?', (self._encode(path),)))
+
+    def add(self, path, block_index, block_hash):
+        self.db.execute('INSERT OR REPLACE INTO blocks VALUES (?, ?, ?)',
+                        (self._encode(path), block_index, block_hash))
+
+    def forget(self, path):
+        self.db.execute('DELETE FROM blocks WHERE path = ?', (self._encode(path),))
+
+    def commit(self):
+        self.db.commit()
+
+    def remove(self):
+        self.db.close()
+        os.unlink(self.path)
+
+
+def block_offsets(node):
+    if node.block_sizes is None:
+        return [i * config.block_size for i in range(len(node.block_hashes))]
+    return [0] + list(itertools.accumulate(node.block_sizes))[:-1]
+
+
+def matches(local_path, node):
+    try:
+        st = os.stat(local_path)
+    except OSError:
+        return False
+    return stat.S_ISREG(st.st_mode) and st.st_size == node.size and abs(st.st_mtime - node.mtime) < 1e-6
+
+
+def preallocate(path, file_size):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        if os.fstat(fd).st_size != file_size:
+            os.ftruncate(fd, 0)
+            if file_size and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(fd, 0, file_size)
+                except OSError:
+                    pass
+            os.ftruncate(fd, file_size)
+    finally:
+        os.close(fd)
+
+
+def set_attributes(path, node):
+    os.chmod(path, stat.S_IMODE(node.mode))
+    os.utime(path, (node.mtime, node.mtime))
+
+
+def fetch_block(remotefs, block_hash, block_format, writes):
+    data = memoryview(remotefs.get_block(block_hash, block_format))
+    written = 0
+    for partial_path, _, offset, start, end in writes:
+        fd = os.open(partial_path, os.O_WRONLY)
+        try:
+            written += os.pwrite(fd, data[start:end], offset)
+        finally:
+            os.close(fd)
+    return written
+
+
+def sync_files(paths):
+    for path in paths:
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def restore(remotefs, remote_path, local_dir):
+    remotefs.fetch_remote()
+    prefix = remote_path.strip('/')
+    if prefix and prefix not in remotefs.dict:
+        logging.error('Remote path not found: %s', remote_path)
+        return False
+    entries = {}
+    for path, node in remotefs.dict.items():
+        if path == prefix:
+            entries['' if node.is_dir else posixpath.basename(path)] = node
+        elif not prefix or path.startswith(prefix + '/'):
+            entries[path[len(prefix):].lstrip('/')] = node
+    journal = RestoreJournal(state_file('restore', os.path.abspath(local_dir), prefix, remotefs.crypto.key))
+
+    logging.info('Creating directories')
+    dirs = sorted(path for path, node in entries.items() if node.is_dir)
+    os.makedirs(local_dir, exist_ok=True)
+    for path in dirs:
+        os.makedirs(os.path.join(local_dir, path), exist_ok=True)
+
+    files = {}
+    positions = collections.OrderedDict()
+    skipped_files = 0
+    total_blocks = 0
+    for path, node in sorted(entries.items()):
+        if node.is_dir:
+            continue
+        local_path = os.path.join(local_dir, path)
+        if matches(local_path, node):
+            skipped_files += 1
+            continue
+        partial_path = local_path + '.cubic-part'
+        done = {}
+        if os.path.exists(partial_path) and os.path.getsize(partial_path) == node.size:
+            done = journal.done(partial_path)
+        else:
+            journal.forget(partial_path)
+        preallocate(partial_path, node.size)
+        remaining = 0
+        if node.pack_offset is not None:
+            source = node.pack_offset, node.pack_offset + node.size
+        else:
+            source = 0, None
+        for block_index, (block_hash, offset) in enumerate(zip(node.block_hashes, block_offsets(node))):
+            total_blocks += 1
+            if done.get(block_index) == block_hash:
+                continue
+            # Keyed by format too: one encrypted block decodes differently in
+            # raw and compressed files.
+            positions.setdefault((block_hash, node.block_format), []).append(
+                (partial_path, block_index, offset, *source))
+            remaining += 1
+        files[partial_path] = [local_path, node, remaining]
+    journal.commit()
+    logging.info('%s files up to date, %s files to restore, %s of %s blocks to fetch (%s distinct)',
+                 skipped_files, len(files), sum(len(w) for w in positions.values()), total_blocks,
+                 len(positions))
+
+    errors = set()
+
+    def finish(partial_path):
+        local_path, node, _ = files[partial_path]
+        try:
+            sync_files([partial_path])
+            os.replace(partial_path, local_path)
+            set_attributes(local_path, node)
+        except OSError as e:
+            logging.exception(e)
+            errors.add(partial_path)
+            return
+        journal.forget(partial_path)
+
+    for partial_path, (_, _, remaining) in files.items():
+        if remaining == 0:
+            finish(partial_path)
+
+    restored_size = 0
+    start_time = last_checkpoint = time.time()
+    touched = set()
+    window = config.restore_workers * 2
+    with concurrent.futures.ThreadPoolExecutor(config.restore_workers) as executor:
+        queue = iter(positions.items())
+        pending = {}
+        while True:
+            for (block_hash, block_format), writes in itertools.islice(queue, window - len(pending)):
+                future = executor.submit(fetch_block, remotefs, block_hash, block_format, writes)
+                pending[future] = block_hash, writes
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                block_hash, writes = pending.pop(future)
+                try:
+                    restored_size += future.result()
+                except Exception as e:
+                    logging.error('Failed to restore block %s: %s', block_hash, e)
+                    errors.update(write[0] for write in writes)
+                    continue
+                for partial_path, block_index, _, _, _ in writes:
+                    journal.add(partial_path, block_index, block_hash)
+                    touched.add(partial_path)
+                    files[partial_path][2] -= 1
+                    if files[partial_path][2] == 0 and partial_path not in errors:
+                        touched.discard(partial_path)
+                        finish(partial_path)
+            if time.time() - last_checkpoint >= config.restore_checkpoint_interval:
+                sync_files(touched)
+                touched.clear()
+                journal.commit()
+                last_checkpoint = time.time()
+                logging.info('Restored %s, %s/s', size(restored_size),
+                             size(restored_size / (last_checkpoint - start_time)))
+    sync_files(touched)
+    journal.commit()
+
+    for path in reversed(dirs):
+        try:
+            set_attributes(os.path.join(local_dir, path), entries[path])
+        except OSError as e:
+            logging.exception(e)
+    if errors:
+        logging.error('%s files could not be restored, run again to resume', len(errors))
+        return False
+    journal.remove()
+    logging.info('All done, restored %s', size(restored_size))
+    return True
+
+
+def init_from_config():
+    coloredlogs.install(level=config.log_level, fmt=config.log_format)
+    metrics.start()
+    server = CubicServer(sys.argv[1], sys.argv[2])
+    if len(sys.argv) >= 6:
+        key = sys.argv[5]
+    else:
+        key = getpass.getpass()
+    cache_path = state_file('tree', sys.argv[1], key) if config.tree_cache else None
+    return RemoteFS(server, key, cache_path), sys.argv[3], sys.argv[4]
+
+
+if __name__ == '__main__':
+    remotefs, remote_path, local_dir = init_from_config()
+    if not restore(remotefs, remote_path, local_dir):
+        sys.exit(1)
@@ -3,111 +3,541 @@
 import coloredlogs
 import sys
 import logging
+import collections
+import concurrent.futures
+import chunking
+import compression
 import config
+import encryption
+import metrics
 from cubic_sdk.cubic import Cubic as CubicServer
 from localfs import LocalFS
+from localindex import LocalIndex
 from remotefs import RemoteFS
 import getpass
-from utils import size
+import itertools
+import os
+import tempfile
+import time
+from utils import size, state_file
+from verify import Verifier
+from watcher import Watcher
 
 
-def generate_diff(base_dict, target_dict):
-    logging.info('Calculating changes')
-    base_set = set(base_dict.keys())
-    target_set = set(target_dict.keys())
-    common_items = base_set & target_set
-    deleted_items = base_set - target_set
-    new_items = target_set - base_set
-    for path in common_items:
-        if base_dict[path] != target_dict[path]:
-            deleted_items.add(path)
-            new_items.add(path)
-    logging.info('%s items to be removed, %s items to be uploaded', len(deleted_items), len(new_items))
-    return sorted(deleted_items), sorted(new_items)
+def path_key(path):
+    return tuple(path.split('/')) if path else ()
+
+
+def diff_streams(base, target, same=None):
+    # Merges two streams of (path, node) in depth-first path order and yields
+    # (path, base_node, target_node) for every path that differs, with None
+    # for the side that does not have it. same(path, base_node, target_node)
+    # is called for the paths that match.
+    base = iter(base)
+    target = iter(target)
+    base_item = next(base, None)
+    target_item = next(target, None)
+    while base_item is not None or target_item is not None:
+        if target_item is None or base_item is not None and path_key(base_item[0]) < path_key(target_item[0]):
+            yield base_item[0], base_item[1], None
+            base_item = next(base, None)
+        elif base_item is None or path_key(target_item[0]) < path_key(base_item[0]):
+            yield target_item[0], None, target_item[1]
+            target_item = next(target, None)
+        else:
+            if base_item[1] != target_item[1]:
+                yield target_item[0], base_item[1], target_item[1]
+            elif same is not None:
+                same(target_item[0], base_item[1], target_item[1])
+            base_item = next(base, None)
+            target_item = next(target, None)
 
 
 class UploadBuffer:
-    def __init__(self, remotefs: RemoteFS, max_size=config.upload_max_size):
+    # Uploads batches of blocks on a few threads while reading goes on.
+    # Batches that do not fit in memory wait on disk until the network
+    # catches up.
+    def __init__(self, remotefs: RemoteFS, max_size=config.upload_max_size, memory_size=config.upload_memory_size,
+                 batch_size=config.upload_batch_size, threads=config.upload_threads):
         self.remotefs = remotefs
         self.max_size = max_size
+        self.memory_size = memory_size
+        self.batch_size = batch_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
         self.blocks = {}
+        self.blocks_size = 0
+        self.queued = set()
+        self.uploading = {}
+        self.uploading_size = 0
+        self.spilled = collections.deque()
+        self.spilled_size = 0
+        self.spill_dir = None
 
     def size(self):
-        return sum(len(b) for b in self.blocks.values())
+        return self.blocks_size + self.uploading_size + self.spilled_size
 
     def check_dup_local(self, block_hash):
-        return block_hash in self.blocks or block_hash in remotefs.all_block_hashes
+        return block_hash in self.queued or block_hash in self.remotefs.all_block_hashes
 
     def upload_all(self):
-        if not self.blocks:
-            return
-        self.remotefs.all_block_hashes.update(self.blocks)
-        exists = self.remotefs.check_hashes(self.blocks)
-        for block_hash in exists:
-            del self.blocks[block_hash]
+        self.flush()
+        while self.uploading or self.spilled:
+            self.collect(wait=True)
+
+    def flush(self):
+        self.collect()
         if self.blocks:
-            self.remotefs.put_encrypted_blocks(self.blocks.values())
-            self.blocks.clear()
+            blocks, self.blocks = self.blocks, {}
+            blocks_size, self.blocks_size = self.blocks_size, 0
+            if self.uploading and self.uploading_size + blocks_size > self.memory_size:
+                self.spill(blocks, blocks_size)
+            else:
+                self.submit(self.upload_batch, blocks, list(blocks), blocks_size)
+        while self.size() > self.max_size:
+            self.collect(wait=True)
+
+    def submit(self, fn, arg, block_hashes, blocks_size):
+        future = self.executor.submit(fn, arg)
+        self.uploading[future] = block_hashes, blocks_size
+        self.uploading_size += blocks_size
+
+    def collect(self, wait=False):
+        if wait and self.uploading:
+            concurrent.futures.wait(self.uploading, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in [f for f in self.uploading if f.done()]:
+            block_hashes, blocks_size = self.uploading.pop(future)
+            self.uploading_size -= blocks_size
+            future.result()
+            self.remotefs.all_block_hashes.update(block_hashes)
+            self.queued.difference_update(block_hashes)
+        while self.spilled and (not self.uploading or
+                                self.uploading_size + self.spilled[0][2] <= self.memory_size):
+            spill_path, index, blocks_size = self.spilled.popleft()
+            self.spilled_size -= blocks_size
+            self.submit(self.upload_spilled, (spill_path, index), [h for h, _ in index], blocks_size)
 
-    def put_block(self, block_data):
-        encrypted_block_data = self.remotefs.crypto.encrypt(block_data)
-        block_hash = config.hash_algo(encrypted_block_data)
+    def spill(self, blocks, blocks_size):
+        if self.spill_dir is None:
+            os.makedirs(config.cache_dir, exist_ok=True)
+            self.spill_dir = tempfile.TemporaryDirectory(prefix='spill-', dir=config.cache_dir)
+        with tempfile.NamedTemporaryFile(dir=self.spill_dir.name, delete=False) as f:
+            for block in blocks.values():
+                f.write(block)
+        logging.info('Network is behind, spilled %s blocks to disk', len(blocks))
+        self.spilled.append((f.name, [(h, len(b)) for h, b in blocks.items()], blocks_size))
+        self.spilled_size += blocks_size
+
+    def upload_spilled(self, spill):
+        spill_path, index = spill
+        blocks = {}
+        with open(spill_path, 'rb') as f:
+            for block_hash, length in index:
+                blocks[block_hash] = f.read(length)
+        self.upload_batch(blocks)
+        os.unlink(spill_path)
+
+    def upload_batch(self, blocks):
+        for attempt in itertools.count():
+            try:
+                exists = set(self.remotefs.check_hashes(blocks))
+                missing = [block for block_hash, block in blocks.items() if block_hash not in exists]
+                if missing:
+                    self.remotefs.put_encrypted_blocks(missing)
+                return
+            except Exception as e:
+                if attempt >= config.upload_retries:
+                    raise
+                delay = config.upload_retry_delay * 2 ** attempt
+                logging.warning('Uploading blocks failed, retrying in %s seconds: %s', delay, e)
+                time.sleep(delay)
+
+    def put_encrypted_block(self, block_hash, encrypted_block_data):
         if not self.check_dup_local(block_hash):
+            self.queued.add(block_hash)
             self.blocks[block_hash] = encrypted_block_data
-            if self.size() >= self.max_size:
-                self.upload_all()
+            self.blocks_size += len(encrypted_block_data)
+            if self.blocks_size >= self.batch_size:
+                self.flush()
         return block_hash
 
 
-def sync(localfs, remotefs):
-    remotefs.fetch_remote()
-    if config.check_integrity:
-        if len(remotefs.check_hashes(remotefs.all_block_hashes)) != len(remotefs.all_block_hashes):
-            logging.error('Some of the remote blocks are missing')
+class Packer:
+    # Collects small files into shared pack blocks, which are encrypted in
+    # the pool. Files get their hashes once their pack is encrypted and
+    # queued for upload.
+    def __init__(self, buffer: UploadBuffer, pool, pack_size=config.pack_size):
+        self.buffer = buffer
+        self.pool = pool
+        self.pack_size = pack_size
+        self.files = []
+        self.data = bytearray()
+        self.sealing = collections.deque()
+
+    def add(self, path, item, data):
+        item.pack_offset = len(self.data)
+        self.data += data
+        self.files.append((path, item))
+        if len(self.data) >= self.pack_size:
+            self.seal()
+
+    def seal(self):
+        if not self.files:
             return
-    localfs.generate_dict()
-    deleted_items, new_items = generate_diff(remotefs.dict, localfs.dict)
-    if not deleted_items and not new_items:
-        logging.info('Already up to date')
+        self.sealing.append((self.pool.apply_async(encrypt_block, (bytes(self.data),)), self.files))
+        logging.info('Packed %s files into %s bytes', len(self.files), len(self.data))
+        metrics.inc('files_packed', len(self.files))
+        self.files = []
+        self.data = bytearray()
+
+    def collect(self, wait=False):
+        # Returns the (path, item) pairs of the files whose packs have been
+        # encrypted and queued for upload, in order.
+        files = []
+        while self.sealing and (wait or self.sealing[0][0].ready()):
+            result, pack_files = self.sealing.popleft()
+            block_hash, encrypted_block_data, _ = result.get()
+            self.buffer.put_encrypted_block(block_hash, encrypted_block_data)
+            for _, item in pack_files:
+                item.block_hashes = [block_hash]
+            files.extend(pack_files)
+        return files
+
+
+def read_small_file(path, size, mode, mtime):
+    # Runs in the pool; reads a whole file to be packed.
+    with open(path, 'rb') as f:
+        data = f.read(size + 1)
+        st = os.fstat(f.fileno())
+    if len(data) != size or st.st_size != size or st.st_mode != mode or st.st_mtime != mtime:
+        raise OSError('File changed while syncing: %s' % path)
+    return data
+
+
+def encrypt_block(block_data):
+    # Runs in the pool; returns the time spent compressing, encrypting and
+    # hashing along with the block.
+    times = [time.perf_counter()]
+    if config.compression:
+        block_data = compression.pack_block(block_data)
+    times.append(time.perf_counter())
+    encrypted_block_data = encryption.worker_crypto.encrypt(block_data)
+    times.append(time.perf_counter())
+    block_hash = config.hash_algo(encrypted_block_data)
+    times.append(time.perf_counter())
+    return block_hash, encrypted_block_data, [b - a for a, b in zip(times, times[1:])]
+
+
+def read_block(path, offset, length):
+    # Runs in the pool; returns the time spent in each stage along with the
+    # block so the main process can record it.
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        block_data = f.read(length)
+    if len(block_data) != length:
+        raise OSError('File changed while syncing: %s' % path)
+    read_time = time.perf_counter() - start
+    block_hash, encrypted_block_data, times = encrypt_block(block_data)
+    return block_hash, encrypted_block_data, [read_time] + times
+
+
+def hash_block(path, offset, length):
+    block_hash, encrypted_block_data, _ = read_block(path, offset, length)
+    return block_hash, len(encrypted_block_data)
+
+
+def _chunk_result(localfs, path, item, scans):
+    if scans is None:
+        return path, item, None
+    try:
+        candidates = []
+        for result in scans:
+            candidates.extend(result.get())
+        return path, item, chunking.cut_points(localfs.realpath(path), item.size, candidates)
+    except OSError as e:
+        return path, item, e
+
+
+def file_chunks(pool, localfs, files, lookahead, pack_max_size=0):
+    # Yields (path, item, block_sizes) in order for the (path, item) pairs
+    # in files. block_sizes is None for fixed-size blocks and files to be
+    # packed, the list of chunk lengths with content-defined chunking (hashed
+    # ahead in the pool, one task per segment), or an OSError if chunking
+    # failed.
+    pending = collections.deque()
+    for path, item in files:
+        if config.content_defined_chunking and item.size > pack_max_size:
+            realpath = localfs.realpath(path)
+            pending.append((path, item, [pool.apply_async(chunking.scan, (realpath, start, end))
+                                         for start, end in chunking.segments(item.size)]))
+        else:
+            pending.append((path, item, None))
+        while len(pending) > lookahead:
+            yield _chunk_result(localfs, *pending.popleft())
+    while pending:
+        yield _chunk_result(localfs, *pending.popleft())
+
+
+def pipeline_blocks(pool, localfs, files, window, skip=None, reader=None, pack_max_size=0):
+    # Yields ('block', path, item, async_result) for every block of a file in
+    # order, then ('end', path, item, block_sizes), or ('error', path, item,
+    # exception) if the file could not be chunked; at most `window` blocks
+    # are in flight at once. The first skip[path] blocks of a file are not
+    # read. Blocks are handled by reader in the pool, read_block by default.
+    # Non-empty files up to pack_max_size are read whole instead and yield a
+    # single ('packed', path, item, async_result).
+    reader = reader or read_block
+    pending = collections.deque()
+    for path, item, block_sizes in file_chunks(pool, localfs, files, window, pack_max_size):
+        if isinstance(block_sizes, OSError):
+            pending.append(('error', path, item, block_sizes))
+            continue
+        realpath = localfs.realpath(path)
+        if 0 < item.size <= pack_max_size:
+            pending.append(('packed', path, item,
+                            pool.apply_async(read_small_file, (realpath, item.size, item.mode, item.mtime))))
+            while len(pending) > window:
+                yield pending.popleft()
+            continue
+        if block_sizes is None:
+            file_size = item.size
+            lengths = (min(config.block_size, file_size - offset) for offset in range(0, file_size, config.block_size))
+        else:
+            lengths = block_sizes
+        offset = 0
+        for block_index, length in enumerate(lengths):
+            if not skip or block_index >= skip.get(path, 0):
+                pending.append(('block', path, item, pool.apply_async(reader, (realpath, offset, length))))
+            offset += length
+            while len(pending) > window:
+                yield pending.popleft()
+        pending.append(('end', path, item, block_sizes))
+    while pending:
+        yield pending.popleft()
+
+
+def commit_progress(localfs, remotefs, buffer, add, remove, partial=None):
+    # Makes everything finished so far durable: blocks on the server, items
+    # in the remote tree and their hashes in the local index, together with
+    # the blocks already uploaded for the file being read.
+    buffer.upload_all()
+    logging.info('All blocks uploaded')
+    if add or remove:
+        remotefs.update_remote(add=add, remove=remove)
+    if localfs.index is not None:
+        for path, node in add.items():
+            if not node.is_dir:
+                localfs.update_index(path, node)
+        localfs.index.clear_partial()
+        if partial is not None:
+            localfs.update_partial(*partial)
+        localfs.index.commit()
+
+
+def finish_index(localfs):
+    # Drops the index entries of files the full scan did not see.
+    if localfs.index is None:
         return
+    localfs.index.retain_scanned()
+    localfs.index.clear_partial()
+    localfs.index.commit()
+
+
+def sync(localfs, remotefs, verifier=None):
+    remotefs.fetch_remote()
+    if verifier is not None and verifier.run():
+        logging.error('Some of the remote blocks are missing')
+        return
+    changed = sync_changes(localfs, remotefs, diff_streams(remotefs.walk(), localfs.walk(), localfs.unchanged))
+    finish_index(localfs)
+    if changed:
+        remotefs.save_cache()
+    logging.info('All done' if changed else 'Already up to date')
+
 
-    total_files = sum(1 for path in new_items if not localfs.dict[path].is_dir)
-    total_size = sum(localfs.dict[path].size for path in new_items if not localfs.dict[path].is_dir)
+def sync_paths(localfs, remotefs, paths):
+    # Syncs only the subtrees at the given paths, plus the nodes of their
+    # parent directories.
+    roots = []
+    for path in sorted(paths, key=path_key):
+        if roots and path_key(path)[:len(path_key(roots[-1]))] == path_key(roots[-1]):
+            continue
+        roots.append(path)
+    parents = sorted({root.rpartition('/')[0] for root in roots if root} - set(roots), key=path_key)
 
+    def changes():
+        for parent in parents:
+            try:
+                node = localfs.get_dir_node(parent)
+            except OSError:
+                continue
+            old = remotefs.dict.get(parent)
+            if old is None or old != node:
+                yield parent, old, node
+        for root in roots:
+            yield from diff_streams(remotefs.walk(root), localfs.walk(root), localfs.unchanged)
+
+    if sync_changes(localfs, remotefs, changes()):
+        logging.info('All done')
+
+
+def sync_changes(localfs, remotefs, changes):
     error_items = set()
     processed_files = 0
     processed_size = 0
     buffer = UploadBuffer(remotefs)
+    pool = remotefs.crypto.pool
+    packer = Packer(buffer, pool)
+    pack_max_size = config.pack_max_file_size if config.pack_small_files else 0
+    deleted = set()
+    committed = 0
+    finished = {}
+    resume = {}
+    skip = {}
 
-    logging.info('Start uploading files')
-    for path in new_items:
-        item = localfs.dict[path]
-        if not item.is_dir:
+    def changed_files():
+        # Diffs the local scan against the remote tree as both are walked and
+        # yields the files that need reading; everything else is queued for
+        # the next commit directly.
+        logging.info('Calculating changes')
+        for path, old, item in changes:
+            if old is not None:
+                deleted.add(path)
+            if item is None:
+                continue
+            if item.is_dir:
+                finished[path] = item
+                continue
+            if item.block_hashes is not None and all(h in remotefs.all_block_hashes for h in item.block_hashes):
+                logging.info('Blocks already uploaded, skipping read: %s', path)
+                finished[path] = item
+                continue
+            item.block_hashes = None
+            item.block_sizes = None
+            item.block_format = compression.BLOCK_FORMAT if config.compression else 0
+            item.pack_offset = None
+            if localfs.index is not None and not 0 < item.size <= pack_max_size:
+                done = localfs.lookup_partial(path, item.block_format)
+                if done:
+                    logging.info('Resuming after %s uploaded blocks: %s', len(done), path)
+                    resume[path] = done
+                    skip[path] = len(done)
+                    remotefs.all_block_hashes.update(done)
+            yield path, item
+
+    logging.info('Start uploading files with %s workers', remotefs.crypto.workers)
+    last_checkpoint = time.time()
+    current_path = None
+    for kind, path, item, result in pipeline_blocks(pool, localfs, changed_files(), remotefs.crypto.workers * 4,
+                                                    skip, pack_max_size=pack_max_size):
+        if path != current_path:
+            current_path = path
             processed_files += 1
             processed_size += item.size
-            logging.info('Processing file [%s/%s][%s/%s][%s] %s', processed_files, total_files,
-                         size(processed_size), size(total_size), size(item.size), path)
+            metrics.inc('files_read')
+            logging.info('Processing file [%s][%s][%s] %s', processed_files,
+                         size(processed_size), size(item.size), path)
+            item.block_hashes = list(resume.get(path, ()))
+        if path not in error_items:
             try:
-                if localfs.get_file_node(path) != item:
-                    logging.warning('File changed while syncing, skipping')
-                    error_items.add(path)
-                with open(localfs.realpath(path), 'rb') as f:
-                    item.block_hashes = []
-                    for block_data in iter(lambda: f.read(config.block_size), b''):
-                        block_hash = buffer.put_block(block_data)
-                        item.block_hashes.append(block_hash)
+                if kind == 'block':
+                    with metrics.timer('pipeline_wait'):
+                        block_hash, encrypted_block_data, times = result.get()
+                    for stage, seconds in zip(('read', 'compress', 'encrypt', 'hash'), times):
+                        metrics.observe(stage, seconds)
+                    metrics.inc('blocks_read')
+                    metrics.inc('bytes_encrypted', len(encrypted_block_data))
+                    item.block_hashes.append(buffer.put_encrypted_block(block_hash, encrypted_block_data))
+                elif kind == 'packed':
+                    with metrics.timer('pipeline_wait'):
+                        packer.add(path, item, result.get())
+                elif kind == 'error':
+                    raise result
+                else:
+                    item.block_sizes = result
+                    if localfs.get_file_node(path) != item:
+                        logging.warning('File changed while syncing, skipping')
+                        error_items.add(path)
+                    else:
+                        finished[path] = item
             except OSError as e:
                 logging.exception(e)
                 error_items.add(path)
-    buffer.upload_all()
-    logging.info('All blocks uploaded')
-    add = {path: localfs.dict[path] for path in new_items if path not in error_items}
-    remotefs.update_remote(add=add, remove=deleted_items)
-    logging.info('All done')
+        finished.update(packer.collect())
+        if time.time() - last_checkpoint >= config.sync_checkpoint_interval:
+            packer.seal()
+            finished.update(packer.collect(wait=True))
+            logging.info('Checkpoint, committing %s finished items', len(finished))
+            partial = None
+            if path not in finished and path not in error_items:
+                partial = path, item.block_hashes, item.block_format
+            commit_progress(localfs, remotefs, buffer, finished, [p for p in finished if p in deleted], partial)
+            deleted.difference_update(finished)
+            committed += len(finished)
+            finished.clear()
+            last_checkpoint = time.time()
+    packer.seal()
+    finished.update(packer.collect(wait=True))
+    for path in error_items:
+        localfs.forget(path)
+    if not deleted and not committed and not finished and not processed_files:
+        return False
+    logging.info('%s items removed, %s files read, %s items uploaded', len(deleted), processed_files,
+                 committed + len(finished))
+    commit_progress(localfs, remotefs, buffer, finished, list(deleted))
+    return True
+
+
+def watch(localfs, remotefs, verifier=None):
+    # Runs a full sync, then syncs the paths reported by inotify once they
+    # have been quiet for watch_debounce seconds. A full sync runs again
+    # every watch_rescan_interval seconds or when events were lost. After a
+    # failed sync, changes are kept and everything is rescanned
+    # watch_retry_delay seconds later.
+    watcher = Watcher(localfs.base_path)
+    next_rescan = time.time()
+    failed = False
+    changed = set()
+    first_change = None
+    while True:
+        if watcher.overflow or time.time() >= next_rescan:
+            logging.info('Rescanning everything')
+            watcher.overflow = False
+            try:
+                sync(localfs, remotefs, verifier)
+            except Exception:
+                logging.exception('Sync failed, rescanning in %s seconds', config.watch_retry_delay)
+                failed = True
+                next_rescan = time.time() + config.watch_retry_delay
+            else:
+                failed = False
+                changed.clear()
+                next_rescan = time.time() + config.watch_rescan_interval
+        if changed and not failed:
+            timeout = config.watch_debounce
+        else:
+            timeout = max(next_rescan - time.time(), 0)
+        events = watcher.read(timeout)
+        if events and not changed:
+            first_change = time.time()
+        changed |= events
+        if failed or watcher.overflow or time.time() >= next_rescan:
+            continue
+        if changed and (not events or time.time() - first_change >= config.watch_max_delay):
+            logging.info('Syncing %s changed paths', len(changed))
+            try:
+                sync_paths(localfs, remotefs, changed)
+            except Exception:
+                logging.exception('Sync failed, rescanning in %s seconds', config.watch_retry_delay)
+                failed = True
+                next_rescan = time.time() + config.watch_retry_delay
+            else:
+                changed.clear()
 
 
 def init_from_config():
     coloredlogs.install(level=config.log_level, fmt=config.log_format)
+    metrics.start()
     server = CubicServer(sys.argv[1], sys.argv[2])
     local_dir = sys.argv[3]
     if len(sys.argv) >= 5:
@@ -119,11 +549,25 @@ def init_from_config():
             key = pw1
         else:
             exit(-1)
-    localfs = LocalFS(local_dir)
-    remotefs = RemoteFS(server, key)
-    return localfs, remotefs
+    index = None
+    if config.local_index:
+        index = LocalIndex(state_file('index', os.path.abspath(local_dir), key))
+    localfs = LocalFS(local_dir, index)
+    cache_path = state_file('tree', sys.argv[1], key) if config.tree_cache else None
+    remotefs = RemoteFS(server, key, cache_path)
+    verifier = Verifier(remotefs, state_file('verified', sys.argv[1], key)) if config.check_integrity else None
+    return localfs, remotefs, verifier
 
 
 if __name__ == '__main__':
-    localfs, remotefs = init_from_config()
-    sync(localfs, remotefs)
+    watch_mode = '--watch' in sys.argv
+    if watch_mode:
+        sys.argv.remove('--watch')
+    localfs, remotefs, verifier = init_from_config()
+    try:
+        if watch_mode:
+            watch(localfs, remotefs, verifier)
+        else:
+            sync(localfs, remotefs, verifier)
+    finally:
+        remotefs.crypto.close()
@@ -1,14 +1,59 @@
 from Cryptodome.Cipher import AES
 from Cryptodome.Hash import HMAC, SHA256, SHA3_256
+import atexit
+import collections
+import config
+import itertools
 import multiprocessing
 
+# The Encryption instance owned by a pool worker process.
+worker_crypto = None
+
+
+def _init_worker(crypto):
+    global worker_crypto
+    worker_crypto = crypto
+
+
+def _encrypt_batch(batch):
+    return [worker_crypto.encrypt(data) for data in batch]
+
+
+def _decrypt_batch(batch):
+    return [worker_crypto.decrypt(data) for data in batch]
+
 
 class Encryption:
-    def __init__(self, key):
+    def __init__(self, key, workers=config.crypto_workers):
         if key:
             self.key = SHA3_256.new().update(key.encode()).digest()[:16]
         else:
             self.key = None
+        self.workers = workers
+        self._pool = None
+
+    def __getstate__(self):
+        return {'key': self.key, 'workers': self.workers}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pool = None
+
+    @property
+    def pool(self):
+        # One long-lived worker pool, shared by metadata crypto and the sync
+        # block pipeline.
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers, _init_worker, (self,))
+            atexit.register(self.close)
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            atexit.unregister(self.close)
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
 
     def _hmac(self, data):
         return HMAC.new(self.key, digestmod=SHA256).update(data).digest()
@@ -28,6 +73,27 @@ class Encryption:
         ciphertext = data[32 + 16:]
         return AES.new(self.key, AES.MODE_GCM, nonce=nonce).decrypt_and_verify(ciphertext, tag)
 
+    def _parallel(self, func, iterable):
+        # Sends batches of small items to the pool and yields results in
+        # order, keeping a bounded number of batches in flight.
+        iterator = iter(iterable)
+        pending = collections.deque()
+        while True:
+            batch = list(itertools.islice(iterator, config.crypto_batch_size))
+            if not batch:
+                break
+            pending.append(self.pool.apply_async(func, (batch,)))
+            if len(pending) > self.workers * 4:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+    def parallel_encrypt(self, iterable):
+        if not self.key:
+            return iter(iterable)
+        return self._parallel(_encrypt_batch, iterable)
+
     def parallel_decrypt(self, iterable):
-        pool = multiprocessing.Pool(multiprocessing.cpu_count())
-        return pool.imap(self.decrypt, iterable, 100)
+        if not self.key:
+            return iter(iterable)
+        return self._parallel(_decrypt_batch, iterable)
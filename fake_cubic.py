@@ -0,0 +1,65 @@
+import collections
+import threading
+import time
+
+import config
+
+
+class FakeCubic:
+    # An in-memory stand-in for cubic_sdk's Cubic. Every call waits `latency`
+    # seconds, and all transfers share one link of `bandwidth` bytes/s.
+    def __init__(self, latency=0, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.tree = {}
+        self.blocks = {}
+        self.lock = threading.Lock()
+        self.link_free = 0
+        self.calls = collections.Counter()
+        self.transferred = 0
+
+    def _transfer(self, call, size):
+        delay = self.latency
+        with self.lock:
+            self.calls[call] += 1
+            self.transferred += size
+            if self.bandwidth:
+                now = time.monotonic()
+                self.link_free = max(now, self.link_free) + size / self.bandwidth
+                delay += self.link_free - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def get_tree(self):
+        with self.lock:
+            items = list(self.tree.values())
+        self._transfer('get_tree', sum(len(item.path) + len(item.meta) + 64 * len(item.blocks) for item in items))
+        return items
+
+    def post_tree(self, put_items, delete_paths):
+        put_items = list(put_items)
+        delete_paths = list(delete_paths)
+        self._transfer('post_tree', sum(len(item.path) + len(item.meta) + 64 * len(item.blocks) for item in put_items)
+                       + sum(len(path) for path in delete_paths))
+        with self.lock:
+            for path in delete_paths:
+                del self.tree[path]
+            for item in put_items:
+                self.tree[item.path] = item
+
+    def bulk_head_block(self, hashes):
+        hashes = list(hashes)
+        self._transfer('bulk_head_block', 64 * len(hashes))
+        return [h in self.blocks for h in hashes]
+
+    def bulk_post_block(self, blocks):
+        blocks = [bytes(block) for block in blocks]
+        self._transfer('bulk_post_block', sum(len(block) for block in blocks))
+        with self.lock:
+            for block in blocks:
+                self.blocks[config.hash_algo(block)] = block
+
+    def get_block(self, hash):
+        block = self.blocks[hash]
+        self._transfer('get_block', len(block))
+        return block
@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
 
+import getpass
+import json
+import logging
 import sys
 import os
+import time
+import zlib
+import config
+from localfs import LocalFS
+from utils import size as size_fmt
 
 
 def sizeof_fmt(num, suffix='B'):
@@ -12,28 +20,136 @@ def sizeof_fmt(num, suffix='B'):
     return "%.2f %s%s" % (num, 'Y', suffix)
 
 
-thresholds = []
-for i in range(1, 13):
-    thresholds.append(10 ** i)
-
-counts = [0 for _ in thresholds]
-dircount = 0
-for root, dirs, files in os.walk(sys.argv[1]):
-    dircount += 1
-    for file in files:
-        try:
-            size = os.stat(os.path.join(root, file)).st_size
-        except:
-            print('Error:', os.path.join(root, file))
-            continue
-        for i, t in enumerate(thresholds):
-            if size < t:
-                counts[i] += 1
-                break
-
-print('Dir count =', dircount)
-print('File count =', sum(counts))
-last = 0
-for i, t in enumerate(thresholds):
-    print(sizeof_fmt(last), '<= size <', sizeof_fmt(t), ':', counts[i])
-    last = t
+def analyze(path):
+    thresholds = []
+    for i in range(1, 13):
+        thresholds.append(10 ** i)
+
+    counts = [0 for _ in thresholds]
+    dircount = 0
+    for root, dirs, files in os.walk(path):
+        dircount += 1
+        for file in files:
+            try:
+                size = os.stat(os.path.join(root, file)).st_size
+            except:
+                print('Error:', os.path.join(root, file))
+                continue
+            for i, t in enumerate(thresholds):
+                if size < t:
+                    counts[i] += 1
+                    break
+
+    print('Dir count =', dircount)
+    print('File count =', sum(counts))
+    last = 0
+    for i, t in enumerate(thresholds):
+        print(sizeof_fmt(last), '<= size <', sizeof_fmt(t), ':', counts[i])
+        last = t
+
+
+def sampled(path, rate):
+    # Picks the same files on every run for a given rate.
+    return rate >= 1 or zlib.crc32(path.encode('utf8', errors='surrogateescape')) < rate * 2 ** 32
+
+
+def plan(path, options):
+    # Hashes the files the way sync would and projects the cost of syncing
+    # them. With sampling, counts are scaled up by the share of bytes read,
+    # so duplicates between sampled and unsampled files are not seen.
+    # Imported here so the plain histogram works without the SDK installed.
+    import coloredlogs
+    import cubic_sync
+    from cubic_sdk.cubic import Cubic as CubicServer
+    from remotefs import RemoteFS
+    coloredlogs.install(level=config.log_level, fmt=config.log_format)
+    key = options.get('key') or getpass.getpass()
+    rate = float(options.get('sample', 1))
+    server = None
+    if 'remote' in options:
+        user, _, token = options['remote'].partition(':')
+        server = CubicServer(user, token)
+    remotefs = RemoteFS(server, key)
+    if server is not None:
+        remotefs.fetch_remote()
+    localfs = LocalFS(path)
+    files = [(p, node) for p, node in localfs.walk() if not node.is_dir]
+    paths = [(p, node) for p, node in files if sampled(p, rate)]
+    total_size = sum(node.size for _, node in files)
+    sampled_size = sum(node.size for _, node in paths)
+
+    logging.info('Hashing %s of %s files', len(paths), len(files))
+    start_time = time.time()
+    blocks = 0
+    errors = 0
+    unique = {}
+    try:
+        for kind, _, _, result in cubic_sync.pipeline_blocks(remotefs.crypto.pool, localfs, paths,
+                                                             remotefs.crypto.workers * 4, reader=cubic_sync.hash_block):
+            try:
+                if kind == 'block':
+                    block_hash, length = result.get()
+                    blocks += 1
+                    unique[block_hash] = length
+                elif kind == 'error':
+                    raise result
+            except OSError as e:
+                logging.warning('Skipping unreadable block: %s', e)
+                errors += 1
+    finally:
+        remotefs.crypto.close()
+    elapsed = max(time.time() - start_time, 1e-6)
+
+    scale = total_size / sampled_size if sampled_size else 1
+    upload = {h: length for h, length in unique.items() if h not in remotefs.all_block_hashes}
+    upload_size = sum(upload.values()) * scale
+    bandwidth = float(options['bandwidth']) * 1024 * 1024 if 'bandwidth' in options else None
+    projection = {
+        'files': len(files),
+        'bytes': total_size,
+        'sample_rate': rate,
+        'sampled_files': len(paths),
+        'sampled_bytes': sampled_size,
+        'block_size': config.block_size,
+        'content_defined_chunking': config.content_defined_chunking,
+        'compression': config.compression,
+        'blocks': round(blocks * scale),
+        'unique_blocks': round(len(unique) * scale),
+        'dedup_ratio': blocks / len(unique) if unique else 1,
+        'remote_blocks': round((len(unique) - len(upload)) * scale) if server is not None else None,
+        'upload_blocks': round(len(upload) * scale),
+        'upload_bytes': round(upload_size),
+        'hash_seconds': elapsed,
+        'hash_bytes_per_second': sampled_size / elapsed,
+        'estimated_read_seconds': total_size * elapsed / sampled_size if sampled_size else 0,
+        'estimated_upload_seconds': upload_size / bandwidth if bandwidth else None,
+        'unreadable_blocks': errors,
+    }
+
+    print('Files: %s, %s' % (projection['files'], size_fmt(total_size)))
+    print('Sampled: %s files, %s' % (len(paths), size_fmt(sampled_size)))
+    print('Blocks: %s, unique: %s, dedup ratio: %.3f'
+          % (projection['blocks'], projection['unique_blocks'], projection['dedup_ratio']))
+    if server is not None:
+        print('Already on remote: %s blocks' % projection['remote_blocks'])
+    print('Upload: %s blocks, %s' % (projection['upload_blocks'], size_fmt(upload_size)))
+    print('Hashing: %s/s, estimated read time %.0f s'
+          % (size_fmt(projection['hash_bytes_per_second']), projection['estimated_read_seconds']))
+    if bandwidth:
+        print('Estimated upload time at %s/s: %.0f s' % (size_fmt(bandwidth), projection['estimated_upload_seconds']))
+    if 'json' in options:
+        if options['json'] in ('', '-'):
+            print(json.dumps(projection, indent=2))
+        else:
+            with open(options['json'], 'w') as f:
+                json.dump(projection, f, indent=2)
+
+
+if __name__ == '__main__':
+    # file_size_analyze.py <dir> [--plan [--sample=<fraction>] [--remote=<user>:<token>]
+    #                             [--key=<key>] [--bandwidth=<MiB/s>] [--json[=<path>]]]
+    options = dict(arg[2:].partition('=')[::2] for arg in sys.argv[2:] if arg.startswith('--'))
+    if 'plan' in options:
+        plan(sys.argv[1], options)
+    else:
+        analyze(sys.argv[1])
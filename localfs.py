@@ -1,43 +1,166 @@
+from blockhashes import BlockHashes
 from node import Node
+from localindex import stat_key
+import chunking
+import collections
+import concurrent.futures
+import config
+import itertools
 import os
 import logging
+import metrics
 import stat
+import time
 
 
 class LocalFS:
-    def __init__(self, base_path):
+    def __init__(self, base_path, index=None):
         self.base_path = base_path
+        self.index = index
         self.clear()
 
     def clear(self):
-        self.dict = {}
+        # Index keys of the files scanned but not yet recorded in the index
+        # or found unchanged.
+        self.index_keys = {}
 
     def realpath(self, path):
         return os.path.join(self.base_path, path)
 
-    def generate_dict(self):
-        logging.info('Scanning local file list')
-        self.clear()
-        for root, dirs, files in os.walk(self.base_path, followlinks=True):
-            dir_path = os.path.relpath(root, self.base_path)
-            if dir_path == '.':
-                dir_path = ''
+    def walk(self, path=''):
+        # Yields (path, node) depth-first in path order, for the whole tree
+        # or the subtree at path, without keeping the nodes. The next
+        # scan_lookahead subdirectories of each directory entered are listed
+        # ahead in the background, so memory stays proportional to depth.
+        full = not path
+        if full:
+            logging.info('Scanning local file list')
+            self.clear()
+            if self.index is not None:
+                self.index.begin_scan()
+        try:
+            root_st = os.stat(self.realpath(path))
+        except OSError as e:
+            if not path:
+                logging.exception(e)
+            return
+        if not stat.S_ISDIR(root_st.st_mode):
             try:
-                self.dict[dir_path] = self.get_dir_node(dir_path)
+                node = self.file_node(path, root_st)
+                if self.index is not None:
+                    self.lookup_index(path, node, root_st)
             except OSError as e:
                 logging.exception(e)
-                continue
-            for file in files:
-                file_path = os.path.join(dir_path, file)
+                return
+            yield path, node
+            return
+        start_time = last_report = time.time()
+        count = 0
+        with concurrent.futures.ThreadPoolExecutor(config.scan_workers) as executor:
+
+            def level(files, subdirs):
+                # Entries of one directory in path order, with the listings
+                # of its next subdirectories in flight.
+                entries = [(p, st, False) for p, st in files] + [(p, st, True) for p, st in subdirs]
+                entries.sort(key=lambda e: e[0])
+                subdirs = iter(sorted(subdirs, key=lambda e: e[0]))
+                listings = collections.deque(executor.submit(self.scan_dir, p, st)
+                                             for p, st in itertools.islice(subdirs, config.scan_lookahead))
+                return iter(entries), listings, subdirs
+
+            stack = [level([], [(path, root_st)])]
+            while stack:
+                entries, listings, subdirs = stack[-1]
+                entry = next(entries, None)
+                if entry is None:
+                    stack.pop()
+                    continue
+                path, st, is_dir = entry
+                if is_dir:
+                    listing = listings.popleft()
+                    for subdir_path, subdir_st in itertools.islice(subdirs, 1):
+                        listings.append(executor.submit(self.scan_dir, subdir_path, subdir_st))
+                    try:
+                        _, dir_st, files, children = listing.result()
+                    except OSError as e:
+                        logging.exception(e)
+                        continue
+                    node = self.dir_node(dir_st)
+                    stack.append(level(files, children))
+                else:
+                    try:
+                        node = self.file_node(path, st)
+                        if self.index is not None:
+                            self.lookup_index(path, node, st)
+                            if full:
+                                self.index.scanned(path)
+                    except OSError as e:
+                        logging.exception(e)
+                        continue
+                count += 1
+                metrics.inc('scanned_items')
+                yield path, node
+                if time.time() - last_report >= config.scan_progress_interval:
+                    last_report = time.time()
+                    logging.info('Scanned %s items, %.0f items/s', count, count / (last_report - start_time))
+        if not full:
+            return
+        elapsed = time.time() - start_time
+        logging.info('%s items in total, scanned in %.1f s (%.0f items/s)',
+                     count, elapsed, count / max(elapsed, 1e-6))
+
+    def scan_dir(self, dir_path, dir_st):
+        files = []
+        subdirs = []
+        with os.scandir(self.realpath(dir_path)) as it:
+            for entry in it:
+                path = os.path.join(dir_path, entry.name)
                 try:
-                    self.dict[file_path] = self.get_file_node(file_path)
+                    if entry.is_dir():
+                        subdirs.append((path, entry.stat()))
+                    else:
+                        files.append((path, entry.stat()))
                 except OSError as e:
                     logging.exception(e)
-                    continue
-        logging.info('%s items in total', len(self.dict))
+        return dir_path, dir_st, files, subdirs
+
+    def lookup_index(self, path, n, st):
+        key = stat_key(st)
+        self.index_keys[path] = key
+        block_hashes, n.block_sizes, n.block_format, n.pack_offset = self.index.lookup(path, key)
+        if block_hashes is not None:
+            n.block_hashes = BlockHashes(block_hashes)
+
+    def update_index(self, path, node):
+        self.index.update(path, self.index_keys.pop(path), node.block_hashes, node.block_sizes, node.block_format,
+                          node.pack_offset)
+
+    def unchanged(self, path, remote_node, node):
+        # Called for nodes that match the remote tree. Files the index does
+        # not know yet get the remote blocks recorded.
+        if self.index is None or node.is_dir:
+            return
+        if node.block_hashes is None:
+            self.update_index(path, remote_node)
+        else:
+            self.forget(path)
+
+    def forget(self, path):
+        self.index_keys.pop(path, None)
+
+    def partial_key(self, path, block_format):
+        return list(self.index_keys[path]) + [block_format] + chunking.params()
+
+    def lookup_partial(self, path, block_format):
+        return self.index.lookup_partial(path, self.partial_key(path, block_format))
+
+    def update_partial(self, path, block_hashes, block_format):
+        self.index.update_partial(path, self.partial_key(path, block_format), block_hashes)
 
     def get_file_node(self, path):
-        st = os.stat(self.realpath(path))
+        return self.file_node(path, os.stat(self.realpath(path)))
+
+    def file_node(self, path, st):
         if not stat.S_ISREG(st.st_mode):
             raise OSError('Not regular file: %s' % path)
         n = Node(is_dir=False, mode=st.st_mode, mtime=st.st_mtime)
@@ -45,5 +168,7 @@ class LocalFS:
         return n
 
     def get_dir_node(self, path):
-        st = os.stat(self.realpath(path))
+        return self.dir_node(os.stat(self.realpath(path)))
+
+    def dir_node(self, st):
         return Node(is_dir=True, mode=st.st_mode, mtime=st.st_mtime)
@@ -0,0 +1,67 @@
+import json
+import sqlite3
+
+
+def stat_key(st):
+    return st.st_size, st.st_mtime, st.st_ino, st.st_dev
+
+
+class LocalIndex:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path BLOB PRIMARY KEY, size INTEGER, mtime REAL, '
+                        'ino INTEGER, dev INTEGER, block_hashes TEXT, block_sizes TEXT, block_format INTEGER, '
+                        'pack_offset INTEGER)')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(files)')]
+        for column, column_type in ('block_sizes', 'TEXT'), ('block_format', 'INTEGER'), ('pack_offset', 'INTEGER'):
+            if column not in columns:
+                self.db.execute('ALTER TABLE files ADD COLUMN %s %s' % (column, column_type))
+        # Blocks already uploaded for files that an interrupted sync was in
+        # the middle of.
+        self.db.execute('CREATE TABLE IF NOT EXISTS partial (path BLOB PRIMARY KEY, key TEXT, block_hashes TEXT)')
+
+    @staticmethod
+    def _encode(path):
+        return path.encode('utf8', errors='surrogateescape')
+
+    def lookup(self, path, key):
+        row = self.db.execute('SELECT size, mtime, ino, dev, block_hashes, block_sizes, block_format, pack_offset '
+                              'FROM files WHERE path = ?', (self._encode(path),)).fetchone()
+        if row is None or tuple(row[:4]) != key:
+            return None, None, 0, None
+        return json.loads(row[4]), json.loads(row[5]) if row[5] else None, row[6] or 0, row[7]
+
+    def update(self, path, key, block_hashes, block_sizes, block_format, pack_offset):
+        self.db.execute('INSERT OR REPLACE INTO files (path, size, mtime, ino, dev, block_hashes, block_sizes, '
+                        'block_format, pack_offset) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (self._encode(path), *key, json.dumps(list(block_hashes)),
+                         json.dumps(block_sizes) if block_sizes is not None else None, block_format, pack_offset))
+
+    def lookup_partial(self, path, key):
+        row = self.db.execute('SELECT key, block_hashes FROM partial WHERE path = ?', (self._encode(path),)).fetchone()
+        if row is None or json.loads(row[0]) != list(key):
+            return []
+        return json.loads(row[1])
+
+    def update_partial(self, path, key, block_hashes):
+        self.db.execute('INSERT OR REPLACE INTO partial VALUES (?, ?, ?)',
+                        (self._encode(path), json.dumps(list(key)), json.dumps(list(block_hashes))))
+
+    def clear_partial(self):
+        self.db.execute('DELETE FROM partial')
+
+    def begin_scan(self):
+        # Paths seen by a full scan go to a temporary table, so entries of
+        # files that are gone can be dropped without holding every path.
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS scanned (path BLOB PRIMARY KEY)')
+        self.db.execute('DELETE FROM scanned')
+
+    def scanned(self, path):
+        self.db.execute('INSERT OR IGNORE INTO scanned VALUES (?)', (self._encode(path),))
+
+    def retain_scanned(self):
+        self.db.execute('DELETE FROM files WHERE path NOT IN (SELECT path FROM scanned)')
+        self.db.execute('DELETE FROM scanned')
+
+    def commit(self):
+        self.db.commit()
@@ -0,0 +1,152 @@
+import atexit
+import bisect
+import contextlib
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+
+import config
+
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+# Set by start() when config.metrics is on; every call below is a no-op
+# until then.
+registry = None
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.start_time = time.time()
+
+    def inc(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'time': time.time(),
+                'uptime': time.time() - self.start_time,
+                'counters': dict(self.counters),
+                'timers': {name: {'count': h.count, 'sum': h.sum, 'buckets': list(h.counts)}
+                           for name, h in self.histograms.items()},
+            }
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append('# TYPE cubic_%s_total counter' % name)
+                lines.append('cubic_%s_total %s' % (name, value))
+            for name, h in sorted(self.histograms.items()):
+                lines.append('# TYPE cubic_%s_seconds histogram' % name)
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), h.counts):
+                    cumulative += count
+                    lines.append('cubic_%s_seconds_bucket{le="%s"} %s' % (name, bound, cumulative))
+                lines.append('cubic_%s_seconds_sum %s' % (name, h.sum))
+                lines.append('cubic_%s_seconds_count %s' % (name, h.count))
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        registry.observe(self.name, time.perf_counter() - self.start)
+
+
+def inc(name, value=1):
+    if registry is not None:
+        registry.inc(name, value)
+
+
+def observe(name, seconds):
+    if registry is not None:
+        registry.observe(name, seconds)
+
+
+def timer(name):
+    if registry is None:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_snapshot():
+    snapshot = json.dumps(registry.snapshot())
+    if not config.metrics_path:
+        logging.info('Metrics: %s', snapshot)
+        return
+    tmp_path = config.metrics_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(snapshot)
+    os.replace(tmp_path, config.metrics_path)
+
+
+def _snapshot_loop():
+    while True:
+        time.sleep(config.metrics_interval)
+        write_snapshot()
+
+
+def start():
+    global registry
+    if not config.metrics or registry is not None:
+        return
+    registry = Registry()
+    threading.Thread(target=_snapshot_loop, daemon=True).start()
+    atexit.register(write_snapshot)
+    if config.metrics_port:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', config.metrics_port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info('Serving metrics at http://127.0.0.1:%s/metrics', config.metrics_port)
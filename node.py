@@ -1,4 +1,6 @@
 class Node:
+    __slots__ = ('is_dir', 'mode', 'mtime', 'size', 'block_hashes', 'block_sizes', 'block_format', 'pack_offset')
+
     def __init__(self, *, is_dir, mode, mtime):
         self.is_dir = is_dir
         self.mode = mode
@@ -6,6 +8,9 @@ class Node:
         if not self.is_dir:
             self.size = None
             self.block_hashes = None
+            self.block_sizes = None
+            self.block_format = 0
+            self.pack_offset = None
 
     def __eq__(self, other):
         if self.is_dir != other.is_dir:
@@ -1,29 +1,106 @@
 from cubic_sdk.cubic import Item as SDK_Node, Cubic as CubicServer
+from blockhashes import BlockHashes, BlockHashSet
 from node import Node
 import json
 from encryption import Encryption
-import logging
+import compression
+import concurrent.futures
+import config
 import itertools
+import logging
+import metrics
+import os
+import pickle
+import tempfile
+import time
+
+TREE_CACHE_VERSION = 3
 
 
 class RemoteFS:
-    def __init__(self, server: CubicServer, key):
+    def __init__(self, server: CubicServer, key, cache_path=None):
         self.server = server
         self.crypto = Encryption(key)
+        self.cache_path = cache_path
+        # Decrypted blobs of the tree entries posted since the snapshot was
+        # saved; the rest are only kept in the snapshot.
+        self.new_blobs = {}
+        self.cache_saved = 0
         self.clear()
 
     def clear(self):
         self.dict = {}
-        self.all_block_hashes = set()
-
-    def generate_dict(self, items):
-        items1, items2 = itertools.tee(items)
-        iterable = itertools.chain.from_iterable((item.path, item.meta) for item in items1)
-        data = list(self.crypto.parallel_decrypt(iterable))
-        paths, metas = data[::2], data[1::2]
-        for item, path, meta in zip(items2, paths, metas):
-            path = path.decode('utf8', errors='surrogateescape')
-            meta = json.loads(meta.decode())
+        self.children = {}
+        self.all_block_hashes = BlockHashSet()
+
+    @staticmethod
+    def generate_children(tree):
+        children = {}
+        for path, node in tree.items():
+            if node.is_dir:
+                children.setdefault(path, set())
+            if path:
+                parent, _, name = path.rpartition('/')
+                children.setdefault(parent, set()).add(name)
+        return children
+
+    def add_child(self, path, node):
+        if node.is_dir:
+            self.children.setdefault(path, set())
+        if path:
+            parent, _, name = path.rpartition('/')
+            self.children.setdefault(parent, set()).add(name)
+
+    def remove_child(self, path, node):
+        if node.is_dir and not self.children.get(path):
+            self.children.pop(path, None)
+        if path:
+            parent, _, name = path.rpartition('/')
+            siblings = self.children.get(parent)
+            if siblings is not None:
+                siblings.discard(name)
+                if not siblings and parent not in self.dict:
+                    del self.children[parent]
+
+    def walk(self, path=''):
+        # Yields (path, node) depth-first in path order using the children
+        # index, for the whole tree or the subtree at path.
+        stack = [iter([path])]
+        while stack:
+            path = next(stack[-1], None)
+            if path is None:
+                stack.pop()
+                continue
+            node = self.dict.get(path)
+            if node is not None:
+                yield path, node
+            names = self.children.get(path)
+            if names:
+                stack.append(iter(sorted(path + '/' + name if path else name for name in names)))
+
+    def generate_dict(self, items, known_blobs=None):
+        # Decrypts the blobs not in known_blobs and returns the decrypted
+        # blobs of the whole tree.
+        items = list(items)
+        known_blobs = known_blobs or {}
+        blobs = {}
+        missing = []
+        for item in items:
+            for blob in item.path, item.meta:
+                if blob in known_blobs:
+                    blobs[blob] = known_blobs[blob]
+                elif blob not in blobs:
+                    blobs[blob] = None
+                    missing.append(blob)
+        logging.info('Decrypting %s of %s blobs', len(missing), len(blobs))
+        if missing:
+            with metrics.timer('tree_decrypt'):
+                blobs.update(zip(missing, self.crypto.parallel_decrypt(missing)))
+            metrics.inc('tree_decrypted_blobs', len(missing))
+        new_dict = {}
+        for item in items:
+            path = blobs[item.path].decode('utf8', errors='surrogateescape')
+            meta = json.loads(blobs[item.meta].decode())
             mode = meta['mode']
             mtime = meta['mtime']
             is_dir = path.endswith('/')
@@ -32,54 +109,224 @@ class RemoteFS:
                 path = path[:-1]
             else:
                 n.size = meta['size']
-                n.block_hashes = item.blocks
-                self.all_block_hashes.update(n.block_hashes)
-            self.dict[path] = n
+                n.block_hashes = BlockHashes(item.blocks)
+                n.block_sizes = meta.get('block_sizes')
+                n.block_format = meta.get('block_format', 0)
+                n.pack_offset = meta.get('pack_offset')
+            new_dict[path] = n
+        self.dict = new_dict
+        self.children = self.generate_children(new_dict)
+        self.all_block_hashes = self.block_hash_set(new_dict)
+        return blobs
+
+    @staticmethod
+    def block_hash_set(tree):
+        return BlockHashSet(itertools.chain.from_iterable(
+            n.block_hashes.digests() for n in tree.values() if not n.is_dir))
 
     def fetch_remote(self):
+        # Reuse decrypted blobs from the cached tree, if any, so only new
+        # entries have to be decrypted. They are dropped again once the
+        # snapshot is saved.
+        known_blobs = self.cached_blobs()
         logging.info('Downloading remote file list')
-        items = self.server.get_tree()
-        self.clear()
-        self.generate_dict(items)
+        with metrics.timer('get_tree'):
+            items = self.server.get_tree()
+        blobs = self.generate_dict(items, known_blobs)
+        del known_blobs
         logging.info('%s items in total', len(self.dict))
+        self.save_cache(blobs)
+
+    def cached_blobs(self):
+        cached = self.read_cache()
+        blobs = cached[0] if cached is not None else {}
+        blobs.update(self.new_blobs)
+        return blobs
+
+    def read_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return None
+        logging.info('Loading cached remote file list')
+        try:
+            with open(self.cache_path, 'rb') as f:
+                version, blobs, new_dict = pickle.load(f)
+        except Exception as e:
+            logging.warning('Ignoring broken tree cache: %s', e)
+            return None
+        if version != TREE_CACHE_VERSION:
+            logging.info('Ignoring tree cache from another version')
+            return None
+        return blobs, new_dict
+
+    def load_cache(self):
+        cached = self.read_cache()
+        if cached is None:
+            return False
+        _, new_dict = cached
+        self.dict = new_dict
+        self.children = self.generate_children(new_dict)
+        self.all_block_hashes = self.block_hash_set(new_dict)
+        logging.info('%s cached items in total', len(self.dict))
+        return True
+
+    def save_cache(self, blobs=None):
+        # Without blobs, the new blobs are merged into those of the snapshot.
+        if not self.cache_path:
+            return
+        if blobs is None:
+            blobs = self.cached_blobs()
+        # The snapshot holds decrypted paths, so it is private to the user.
+        # mkstemp creates it 0600 under a name no other process writes to.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.cache_path),
+                                        prefix=os.path.basename(self.cache_path) + '.', suffix='.tmp')
+        try:
+            with open(fd, 'wb') as f:
+                pickle.dump((TREE_CACHE_VERSION, blobs, self.dict), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.new_blobs = {}
+        self.cache_saved = time.time()
 
     def check_hashes(self, hashes):
         hashes = list(hashes)
         logging.info('Checking remote existing blocks')
-        exists = [hash for hash, exist in zip(hashes, self.server.bulk_head_block(hashes)) if exist]
+        with metrics.timer('bulk_head_block'):
+            exists = [hash for hash, exist in zip(hashes, self.server.bulk_head_block(hashes)) if exist]
+        metrics.inc('head_blocks', len(hashes))
         logging.info('%s of %s blocks exists', len(exists), len(hashes))
         return exists
 
+    @staticmethod
+    def tree_entry(path, node):
+        if node.is_dir:
+            return ((path + '/').encode('utf8', errors='surrogateescape'),
+                    json.dumps({'mode': node.mode, 'mtime': node.mtime}).encode(), [])
+        meta = {'mode': node.mode, 'mtime': node.mtime, 'size': node.size}
+        if node.block_sizes is not None:
+            meta['block_sizes'] = node.block_sizes
+        if node.block_format:
+            meta['block_format'] = node.block_format
+        if node.pack_offset is not None:
+            meta['pack_offset'] = node.pack_offset
+        return path.encode('utf8', errors='surrogateescape'), json.dumps(meta).encode(), list(node.block_hashes)
+
+    def tree_batches(self, add, remove):
+        # Groups changes into batches of about tree_batch_size bytes. A path
+        # that is replaced is removed in the same batch that adds it again.
+        remaining = dict.fromkeys(remove)
+        batch_add = []
+        batch_remove = []
+        batch_size = 0
+        for path, node in add.items():
+            entry = self.tree_entry(path, node)
+            batch_add.append((path, node, entry))
+            batch_size += len(entry[0]) + len(entry[1]) + 65 * len(entry[2]) + 96
+            if path in remaining:
+                del remaining[path]
+                batch_remove.append(path)
+                batch_size += len(path) + 48
+            if batch_size >= config.tree_batch_size:
+                yield batch_add, batch_remove
+                batch_add, batch_remove, batch_size = [], [], 0
+        for path in remaining:
+            batch_remove.append(path)
+            batch_size += len(path) + 48
+            if batch_size >= config.tree_batch_size:
+                yield batch_add, batch_remove
+                batch_add, batch_remove, batch_size = [], [], 0
+        if batch_add or batch_remove:
+            yield batch_add, batch_remove
+
+    def encrypt_batch(self, batch_add, batch_remove):
+        plain = []
+        for _, _, (path_data, meta_data, _) in batch_add:
+            plain.append(path_data)
+            plain.append(meta_data)
+        for path in batch_remove:
+            plain.append((path + ('/' if self.dict[path].is_dir else '')).encode('utf8', errors='surrogateescape'))
+        encrypted = self.crypto.parallel_encrypt(plain)
+        put_items = []
+        for _, _, (path_data, meta_data, blocks) in batch_add:
+            path_blob = next(encrypted)
+            meta_blob = next(encrypted)
+            if self.cache_path:
+                self.new_blobs[path_blob] = path_data
+                self.new_blobs[meta_blob] = meta_data
+            put_items.append(SDK_Node(path_blob, meta_blob, blocks))
+        return put_items, list(encrypted)
+
+    def post_tree(self, put_items, delete_paths):
+        for attempt in itertools.count():
+            try:
+                with metrics.timer('post_tree'):
+                    self.server.post_tree(put_items=put_items, delete_paths=delete_paths)
+                break
+            except Exception as e:
+                if attempt >= config.upload_retries:
+                    raise
+                delay = config.upload_retry_delay * 2 ** attempt
+                logging.warning('Updating directory tree failed, retrying in %s seconds: %s', delay, e)
+                time.sleep(delay)
+        metrics.inc('tree_items_posted', len(put_items))
+        metrics.inc('tree_items_deleted', len(delete_paths))
+
+    def apply_batch(self, batch_add, batch_remove):
+        for path in batch_remove:
+            self.remove_child(path, self.dict.pop(path))
+        for path, node, _ in batch_add:
+            if not node.is_dir:
+                node.block_hashes = BlockHashes(node.block_hashes)
+                self.all_block_hashes.update(node.block_hashes)
+            self.dict[path] = node
+            self.add_child(path, node)
+
     def update_remote(self, *, add, remove):
+        # Sends the changes as a stream of post_tree batches. The next batch
+        # is encrypted while the previous one is being posted. The snapshot
+        # is saved at most every tree_cache_interval seconds.
         logging.info('Updating directory tree')
-        remove_list = []
-        for path in remove:
-            remove_list.append(self.crypto.encrypt(
-                (path + ('/' if self.dict[path].is_dir else '')).encode('utf8', errors='surrogateescape')))
-        add_list = []
-        for path, node in add.items():
-            if node.is_dir:
-                add_list.append(SDK_Node(
-                    self.crypto.encrypt((path + '/').encode('utf8', errors='surrogateescape')),
-                    self.crypto.encrypt(json.dumps({'mode': node.mode, 'mtime': node.mtime}).encode()),
-                    [],
-                ))
-            else:
-                add_list.append(SDK_Node(
-                    self.crypto.encrypt(path.encode('utf8', errors='surrogateescape')),
-                    self.crypto.encrypt(
-                        json.dumps({'mode': node.mode, 'mtime': node.mtime, 'size': node.size}).encode()),
-                    node.block_hashes,
-                ))
-        self.server.post_tree(put_items=add_list, delete_paths=remove_list)
+        total = len(add) + len(remove)
+        done = 0
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            posting = None
+            try:
+                for batch in self.tree_batches(add, remove):
+                    put_items, delete_paths = self.encrypt_batch(*batch)
+                    if posting is not None:
+                        posting[0].result()
+                        self.apply_batch(*posting[1])
+                        done += len(posting[1][0]) + len(posting[1][1])
+                        logging.info('Updated %s of %s tree items', done, total)
+                    posting = executor.submit(self.post_tree, put_items, delete_paths), batch
+                if posting is not None:
+                    posting[0].result()
+                    self.apply_batch(*posting[1])
+            finally:
+                if time.time() - self.cache_saved >= config.tree_cache_interval:
+                    self.save_cache()
         logging.info('Directory tree updated')
 
+    def pack_block(self, block):
+        if config.compression:
+            return compression.pack_block(block)
+        return block
+
     def put_blocks(self, blocks):
-        self.put_encrypted_blocks([self.crypto.encrypt(block) for block in blocks])
+        self.put_encrypted_blocks([self.crypto.encrypt(self.pack_block(block)) for block in blocks])
 
     def put_encrypted_blocks(self, blocks):
-        logging.info('Uploading %s blocks, total size %s bytes', len(blocks), sum(len(b) for b in blocks))
-        self.server.bulk_post_block(blocks)
+        blocks_size = sum(len(b) for b in blocks)
+        logging.info('Uploading %s blocks, total size %s bytes', len(blocks), blocks_size)
+        with metrics.timer('bulk_post_block'):
+            self.server.bulk_post_block(blocks)
+        metrics.inc('blocks_uploaded', len(blocks))
+        metrics.inc('bytes_uploaded', blocks_size)
 
-    def get_block(self, hash):
-        return self.crypto.decrypt(self.server.get_block(hash))
+    def get_block(self, hash, block_format=0):
+        with metrics.timer('get_block'):
+            data = self.server.get_block(hash)
+        metrics.inc('bytes_downloaded', len(data))
+        with metrics.timer('block_decrypt'):
+            return compression.unpack_block(self.crypto.decrypt(data), block_format)
@@ -1,6 +1,17 @@
+import config
+import hashlib
+import os
+
+
 def size(num, suffix='B'):
     for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
         if abs(num) < 1024:
             return "%.1f %s%s" % (num, unit, suffix)
         num /= 1024
     return "%.1f %s%s" % (num, 'Yi', suffix)
+
+
+def state_file(name, *identity):
+    os.makedirs(config.cache_dir, mode=0o700, exist_ok=True)
+    digest = hashlib.sha256(repr(identity).encode()).hexdigest()[:16]
+    return os.path.join(config.cache_dir, '%s-%s' % (name, digest))
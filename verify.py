@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import coloredlogs
+import concurrent.futures
+import itertools
+import logging
+import random
+import sqlite3
+import sys
+import time
+import config
+import metrics
+from cubic_sdk.cubic import Cubic as CubicServer
+from remotefs import RemoteFS
+import getpass
+from utils import state_file
+
+
+class VerifyStore:
+    # When each block hash was last seen on the server.
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS verified (hash BLOB PRIMARY KEY, time REAL)')
+
+    def fresh(self, block_hashes, since):
+        digests = [bytes.fromhex(h) for h in block_hashes]
+        rows = self.db.execute('SELECT hash FROM verified WHERE time >= ? AND hash IN (%s)'
+                               % ','.join('?' * len(digests)), (since, *digests))
+        return {row[0].hex() for row in rows}
+
+    def update(self, block_hashes, verified_time):
+        self.db.executemany('INSERT OR REPLACE INTO verified VALUES (?, ?)',
+                            ((bytes.fromhex(h), verified_time) for h in block_hashes))
+
+    def remove(self, block_hashes):
+        self.db.executemany('DELETE FROM verified WHERE hash = ?', ((bytes.fromhex(h),) for h in block_hashes))
+
+    def commit(self):
+        self.db.commit()
+
+
+def batched(iterable, n):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, n))
+        if not batch:
+            return
+        yield batch
+
+
+class Verifier:
+    # Checks that the blocks of the remote tree exist on the server. Hashes
+    # verified within max_age seconds are skipped, except for a random
+    # sample_rate fraction of them.
+    def __init__(self, remotefs: RemoteFS, path, max_age=config.verify_max_age, sample_rate=config.verify_sample_rate):
+        self.remotefs = remotefs
+        self.store = VerifyStore(path)
+        self.max_age = max_age
+        self.sample_rate = sample_rate
+
+    def stale_hashes(self, since):
+        for batch in batched(self.remotefs.all_block_hashes, 500):
+            fresh = self.store.fresh(batch, since)
+            for block_hash in batch:
+                if block_hash not in fresh or self.sample_rate and random.random() < self.sample_rate:
+                    yield block_hash
+
+    def check(self, batch):
+        with metrics.timer('verify_head'):
+            exists = self.remotefs.server.bulk_head_block(batch)
+        metrics.inc('blocks_verified', len(batch))
+        return [h for h, exist in zip(batch, exists) if not exist]
+
+    def run(self):
+        start_time = time.time()
+        total = len(self.remotefs.all_block_hashes)
+        checked = 0
+        missing = set()
+        logging.info('Verifying remote blocks')
+        with concurrent.futures.ThreadPoolExecutor(config.verify_workers) as executor:
+            pending = {}
+            batches = batched(self.stale_hashes(start_time - self.max_age), config.verify_batch_size)
+            while True:
+                for batch in itertools.islice(batches, config.verify_workers * 2 - len(pending)):
+                    pending[executor.submit(self.check, batch)] = batch
+                if not pending:
+                    break
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    batch = pending.pop(future)
+                    absent = future.result()
+                    missing.update(absent)
+                    self.store.remove(absent)
+                    self.store.update(set(batch) - set(absent), start_time)
+                    checked += len(batch)
+                self.store.commit()
+        logging.info('Checked %s of %s blocks in %.1f s, %s missing', checked, total, time.time() - start_time,
+                     len(missing))
+        if missing:
+            for path, node in sorted(self.remotefs.dict.items()):
+                if not node.is_dir and any(h in missing for h in node.block_hashes):
+                    logging.error('Missing blocks in %s', path)
+        return missing
+
+
+def init_from_config():
+    coloredlogs.install(level=config.log_level, fmt=config.log_format)
+    metrics.start()
+    server = CubicServer(sys.argv[1], sys.argv[2])
+    if len(sys.argv) >= 4:
+        key = sys.argv[3]
+    else:
+        key = getpass.getpass()
+    cache_path = state_file('tree', sys.argv[1], key) if config.tree_cache else None
+    remotefs = RemoteFS(server, key, cache_path)
+    return Verifier(remotefs, state_file('verified', sys.argv[1], key))
+
+
+if __name__ == '__main__':
+    verifier = init_from_config()
+    try:
+        verifier.remotefs.fetch_remote()
+        if verifier.run():
+            sys.exit(1)
+    finally:
+        verifier.remotefs.crypto.close()
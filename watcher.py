@@ -0,0 +1,105 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT = struct.Struct('iIII')
+
+
+class Watcher:
+    # Watches a directory tree with inotify and reports changed paths relative
+    # to its root. Sets overflow when events were lost and a rescan is needed.
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.watches = {}
+        self.overflow = False
+        self.add_tree('')
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.base_path, path)), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return
+            if err == errno.ENOSPC:
+                logging.warning('Out of inotify watches, changes under %s rely on rescans', path or '/')
+                self.overflow = True
+                return
+            raise OSError(err, os.strerror(err), path)
+        self.watches[wd] = path
+
+    def add_tree(self, path):
+        self.add_watch(path)
+        try:
+            with os.scandir(os.path.join(self.base_path, path)) as it:
+                subdirs = [os.path.join(path, entry.name) for entry in it if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            return
+        for subdir in subdirs:
+            self.add_tree(subdir)
+
+    def remove_tree(self, path):
+        for wd, watched in list(self.watches.items()):
+            if watched == path or watched.startswith(path + '/'):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read(self, timeout):
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+                offset += EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    self.overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                parent = self.watches.get(wd)
+                if parent is None:
+                    continue
+                path = os.path.join(parent, os.fsdecode(name)) if name else parent
+                changed.add(path)
+                if mask & IN_ISDIR:
+                    if mask & IN_MOVED_FROM:
+                        self.remove_tree(path)
+                    elif mask & (IN_CREATE | IN_MOVED_TO):
+                        self.add_tree(path)
+        return changed